@@ -4,11 +4,19 @@ Invoice Processing Web Application
 Professional UI for TallyPrime integration
 """
 
-from flask import Flask, render_template, request, jsonify, send_file, flash, redirect, url_for
+from quart import Quart, render_template, request, send_file, flash, redirect, url_for
+import asyncio
+import math
 import os
-import json
+import shutil
+import tempfile
+import time
+import orjson
+import aiofiles
+import aiofiles.tempfile
+import httpx
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
-from pathlib import Path
 import logging
 from datetime import datetime
 import traceback
@@ -18,6 +26,10 @@ try:
     from config import validate_config, get_config
     from invoice_processor import InvoiceProcessor
     from complete_working_solution import CompleteTallyIntegration
+    
+    # Long-lived integration shared by every request (keeps its connection pool);
+    # TallyPrime host/port changes require a restart
+    TALLY = CompleteTallyIntegration()
 except ImportError as e:
     print(f"Import error: {e}")
     # Create dummy functions for testing
@@ -26,13 +38,18 @@ except ImportError as e:
     def get_config():
         return validate_config()
 
-app = Flask(__name__)
+app = Quart(__name__)
 app.secret_key = 'invoice_processing_secret_key_2024'
 
 # Configuration
 UPLOAD_FOLDER = '/tmp/uploads'
 RESULTS_FOLDER = '/tmp/results'
 ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg'}
+STREAM_CHUNK_SIZE = 1 << 20  # 1 MiB write buffer for /upload-stream
+
+# Reject oversized bodies early (large multipart file parts already spill to a
+# temp file via werkzeug's default stream factory)
+app.config['MAX_CONTENT_LENGTH'] = get_config().get('max_upload_mb', 100) * 1024 * 1024
 
 # Create directories in /tmp (writable in serverless)
 try:
@@ -45,18 +62,163 @@ except:
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Caps how many invoices are processed at once per worker (Tally QPS); the processor separately
+# caps DeepInfra requests in flight at the same MAX_CONCURRENT, however many pages each invoice has
+processing_semaphore = asyncio.Semaphore(get_config().get('max_concurrent', 4))
+
+# Shared HTTP client, created on first use so it binds to the serving event loop
+_http_client = None
+
+def get_http_client():
+    """Return the shared pooled async HTTP client"""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(http2=True, timeout=5)
+    return _http_client
+
+# One InvoiceProcessor (and its LLM connection pool) for the whole process
+_processor = None
+
+def get_processor(config):
+    """Return the shared InvoiceProcessor, creating it on first use"""
+    global _processor
+    if _processor is None:
+        _processor = InvoiceProcessor(config['deepinfra_token'], max_concurrency=config.get('max_concurrent', 4),
+                                      cache_dir=config.get('cache_dir', '/tmp/invoice_cache'),
+                                      rpm=config.get('llm_rpm', 0), tpm=config.get('llm_tpm', 0),
+                                      batch_size=config.get('llm_batch_size', 1))
+    return _processor
+
+# Last TallyPrime probe as (monotonic time, status code, error), shared by a whole batch
+TALLY_HEALTH_TTL = 10
+_tally_health = None
+_tally_health_lock = asyncio.Lock()
+
+async def check_tally_connection():
+    """Probe TallyPrime, reusing the result for TALLY_HEALTH_TTL seconds"""
+    global _tally_health
+    # The lock makes concurrent invoices wait for one probe instead of each sending their own
+    async with _tally_health_lock:
+        if _tally_health and time.monotonic() - _tally_health[0] < TALLY_HEALTH_TTL:
+            return _tally_health[1], _tally_health[2]
+        
+        config = get_config()
+        base_url = f"http://{config['tally_host']}:{config['tally_port']}"
+        try:
+            response = await get_http_client().get(base_url)
+            status_code, error = response.status_code, None
+        except Exception as e:
+            status_code, error = None, str(e)
+        
+        _tally_health = (time.monotonic(), status_code, error)
+        return status_code, error
+
+@app.after_serving
+async def close_http_client():
+    """Close pooled connections on shutdown"""
+    if _http_client is not None:
+        await _http_client.aclose()
+    if _processor is not None:
+        _processor.close()
+
+# One summary line per saved invoice, appended at save time so /history never opens result files
+HISTORY_INDEX = os.path.join(RESULTS_FOLDER, 'index.jsonl')
+# Summaries parsed so far and the index offset they were read up to
+_history_index = {'offset': 0, 'entries': []}
+HISTORY_PER_PAGE = 50
+HISTORY_MAX_PER_PAGE = 200
+
+def json_response(payload):
+    """Build a JSON response serialized with orjson, sized up front so the connection can be kept alive"""
+    body = orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+    return app.response_class(body, mimetype='application/json', headers={'Content-Length': str(len(body))})
+
+def history_summary(data, json_file, xml_file, timestamp):
+    """Build the /history row for one saved invoice"""
+    return {
+        'timestamp': timestamp,
+        'invoice_number': data.get('invoice_number', 'N/A'),
+        'vendor_name': data.get('vendor_name', 'N/A'),
+        'total_amount': data.get('total_amount', 0),
+        'json_file': os.path.basename(json_file),
+        'xml_file': os.path.basename(xml_file)
+    }
+
+def rebuild_history_index():
+    """Rewrite the history index from the result files (used when it is missing, and to compact it)"""
+    entries = []
+    with os.scandir(RESULTS_FOLDER) as it:
+        for entry in it:
+            if entry.name.startswith('invoice_') and entry.name.endswith('.json') and entry.is_file():
+                try:
+                    with open(entry.path, 'rb') as f:
+                        data = orjson.loads(f.read())
+                except Exception:
+                    continue
+                mtime = entry.stat().st_mtime
+                xml_file = entry.name.replace('invoice_', 'voucher_').replace('.json', '.xml')
+                entries.append((mtime, history_summary(
+                    data, entry.path, xml_file, datetime.fromtimestamp(mtime).strftime("%Y-%m-%d %H:%M:%S"))))
+    
+    # Oldest first, like the appended lines
+    entries.sort(key=lambda item: item[0])
+    # Private temp file per rebuild, so workers rebuilding at once don't clobber each other
+    fd, tmp_path = tempfile.mkstemp(prefix='index_', suffix='.tmp', dir=RESULTS_FOLDER)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b''.join(orjson.dumps(summary) + b'\n' for _, summary in entries))
+        os.replace(tmp_path, HISTORY_INDEX)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def ensure_history_index():
+    """Build the history index from existing result files if it doesn't exist yet (e.g. after an upgrade)"""
+    if not os.path.exists(HISTORY_INDEX):
+        rebuild_history_index()
+
+def read_history_index():
+    """Return every indexed summary, oldest first, reading only lines appended since the last call"""
+    ensure_history_index()
+    
+    with open(HISTORY_INDEX, 'rb') as f:
+        # A shorter file means the index was rebuilt; start over
+        if os.fstat(f.fileno()).st_size < _history_index['offset']:
+            _history_index.update(offset=0, entries=[])
+        
+        f.seek(_history_index['offset'])
+        data = f.read()
+    
+    # Leave a partially written last line for the next visit
+    complete = data[:data.rfind(b'\n') + 1]
+    for line in complete.splitlines():
+        try:
+            _history_index['entries'].append(orjson.loads(line))
+        except orjson.JSONDecodeError:
+            continue
+    _history_index['offset'] += len(complete)
+    
+    return _history_index['entries']
+
+@app.before_serving
+async def prepare_history_index():
+    """Index older results before the first upload appends to (and so creates) the index"""
+    await asyncio.to_thread(ensure_history_index)
+
 def allowed_file(filename):
     """Check if file extension is allowed"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def process_invoice_api(file_path):
-    """Process invoice and return detailed results"""
+async def aprocess_invoice_api(stream, filename):
+    """Process invoice (file-like object plus its original name) and return detailed results"""
     processing_steps = {
         'ai_processing': {'status': 'pending', 'message': '', 'data': None},
         'tally_connection': {'status': 'pending', 'message': '', 'data': None},
         'ledger_creation': {'status': 'pending', 'message': '', 'data': None},
         'voucher_creation': {'status': 'pending', 'message': '', 'data': None}
     }
+    # The integration's per-import voucher copy; moved into RESULTS_FOLDER or removed on the way out
+    temp_xml = None
     
     try:
         config = validate_config()
@@ -64,8 +226,8 @@ def process_invoice_api(file_path):
         # Step 1: AI Processing
         processing_steps['ai_processing']['status'] = 'processing'
         try:
-            processor = InvoiceProcessor(config['deepinfra_token'])
-            json_results = processor.process_invoice_file(file_path)
+            processor = get_processor(config)
+            json_results = await asyncio.to_thread(processor.process_invoice_stream, stream, filename)
             merged_json = processor.merge_json_data(json_results)
             
             processing_steps['ai_processing']['status'] = 'success'
@@ -83,27 +245,24 @@ def process_invoice_api(file_path):
         
         # Step 2: TallyPrime Connection Test
         processing_steps['tally_connection']['status'] = 'processing'
-        try:
-            import requests
-            base_url = f"http://{config['tally_host']}:{config['tally_port']}"
-            response = requests.get(base_url, timeout=5)
-            
-            if response.status_code == 200:
-                processing_steps['tally_connection']['status'] = 'success'
-                processing_steps['tally_connection']['message'] = f'Connected to TallyPrime on {config["tally_host"]}:{config["tally_port"]}'
-            else:
-                processing_steps['tally_connection']['status'] = 'failed'
-                processing_steps['tally_connection']['message'] = f'TallyPrime not responding (HTTP {response.status_code})'
-        except Exception as e:
+        status_code, error = await check_tally_connection()
+        
+        if status_code == 200:
+            processing_steps['tally_connection']['status'] = 'success'
+            processing_steps['tally_connection']['message'] = f'Connected to TallyPrime on {config["tally_host"]}:{config["tally_port"]}'
+        elif error is None:
             processing_steps['tally_connection']['status'] = 'failed'
-            processing_steps['tally_connection']['message'] = f'Cannot connect to TallyPrime: {str(e)}'
+            processing_steps['tally_connection']['message'] = f'TallyPrime not responding (HTTP {status_code})'
+        else:
+            processing_steps['tally_connection']['status'] = 'failed'
+            processing_steps['tally_connection']['message'] = f'Cannot connect to TallyPrime: {error}'
         
         # Step 3: TallyPrime Integration
         processing_steps['ledger_creation']['status'] = 'processing'
         processing_steps['voucher_creation']['status'] = 'processing'
         
-        tally = CompleteTallyIntegration()
-        result = tally.import_complete_invoice(merged_json)
+        result = await TALLY.import_complete_invoice_async(merged_json, get_http_client())
+        temp_xml = result.get('xml_file')
         
         # Update ledger creation status
         processing_steps['ledger_creation']['status'] = 'success'
@@ -121,19 +280,23 @@ def process_invoice_api(file_path):
             processing_steps['voucher_creation']['status'] = 'failed'
             processing_steps['voucher_creation']['message'] = f'Voucher creation failed: {result.get("error", "Unknown error")}'
         
-        # Save results
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        # Save results (microseconds keep names unique across a parallel batch)
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
         json_file = os.path.join(RESULTS_FOLDER, f"invoice_{timestamp}.json")
         xml_file = os.path.join(RESULTS_FOLDER, f"voucher_{timestamp}.xml")
         
-        # Save JSON
-        with open(json_file, 'w', encoding='utf-8') as f:
-            json.dump(merged_json, f, indent=2, ensure_ascii=False)
+        # Save JSON (non-blocking so other invoices keep progressing)
+        async with aiofiles.open(json_file, 'wb') as f:
+            await f.write(orjson.dumps(merged_json, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        
+        # Save XML if available (a rename when both live on the same filesystem, as with the /tmp defaults)
+        if temp_xml and os.path.exists(temp_xml):
+            await asyncio.to_thread(shutil.move, temp_xml, xml_file)
         
-        # Save XML if available
-        if result.get('xml_file') and os.path.exists(result['xml_file']):
-            import shutil
-            shutil.copy(result['xml_file'], xml_file)
+        # One append per invoice; a single small O_APPEND write keeps lines whole across workers
+        summary = history_summary(merged_json, json_file, xml_file, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        async with aiofiles.open(HISTORY_INDEX, 'ab') as f:
+            await f.write(orjson.dumps(summary) + b'\n')
         
         return {
             'success': result['success'],
@@ -163,56 +326,60 @@ def process_invoice_api(file_path):
             'overall_status': 'failed',
             'traceback': traceback.format_exc()
         }
+    
+    finally:
+        if temp_xml and os.path.exists(temp_xml):
+            os.remove(temp_xml)
+
+async def process_with_limit(stream, filename):
+    """Process one invoice while holding a slot of the concurrency cap"""
+    async with processing_semaphore:
+        return await aprocess_invoice_api(stream, filename)
 
 @app.route('/')
-def index():
+async def index():
     """Main page"""
     try:
-        return render_template('index.html')
+        return await render_template('index.html')
     except Exception as e:
         return f"<h1>Invoice Processing App</h1><p>Status: Running</p><p>Error: {str(e)}</p>"
 
 @app.route('/debug')
-def debug():
+async def debug():
     """Debug endpoint"""
-    return jsonify({'status': 'App is running', 'timestamp': datetime.now().isoformat()})
+    return json_response({'status': 'App is running', 'timestamp': datetime.now().isoformat()})
 
 @app.route('/upload', methods=['POST'])
-def upload_file():
+async def upload_file():
     """Handle file upload and processing"""
     try:
         logger.info("Upload request received")
-        logger.info(f"Request files: {request.files}")
-        logger.info(f"Request form: {request.form}")
+        request_files = await request.files
+        logger.info(f"Request files: {request_files}")
+        logger.info(f"Request form: {await request.form}")
         # Handle multiple files
-        files = request.files.getlist('file')
+        files = request_files.getlist('file')
         if not files or all(f.filename == '' for f in files):
-            return jsonify({'success': False, 'error': 'No files selected'})
+            return json_response({'success': False, 'error': 'No files selected'})
         
         results = []
-        total_success = 0
+        pending = []
         total_files = len(files)
         
         for file in files:
             if file and file.filename != '' and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                filename = f"{timestamp}_{filename}"
-                file_path = os.path.join(UPLOAD_FOLDER, filename)
-                file.save(file_path)
-                
-                # Process the invoice
-                result = process_invoice_api(file_path)
-                
-                # Add file info to result
-                result['uploaded_file'] = filename
-                result['original_filename'] = file.filename
-                result['file_size'] = os.path.getsize(file_path)
+                # The parsed upload is handed to the processor as-is, no copy in UPLOAD_FOLDER
+                file.stream.seek(0, os.SEEK_END)
+                file_size = file.stream.tell()
+                file.stream.seek(0)
                 
-                if result['success']:
-                    total_success += 1
-                
-                results.append(result)
+                file_info = {
+                    'uploaded_file': secure_filename(file.filename),
+                    'original_filename': file.filename,
+                    'file_size': file_size
+                }
+                pending.append((len(results), file, file_info))
+                results.append(None)
             else:
                 results.append({
                     'success': False,
@@ -220,7 +387,23 @@ def upload_file():
                     'original_filename': file.filename
                 })
         
-        return jsonify({
+        # Process all invoices concurrently so AI and Tally round-trips overlap
+        outcomes = await asyncio.gather(
+            *(process_with_limit(file.stream, file.filename) for _, file, _ in pending),
+            return_exceptions=True
+        )
+        
+        for (index, _, file_info), result in zip(pending, outcomes):
+            if isinstance(result, BaseException):
+                result = {'success': False, 'error': str(result), 'overall_status': 'failed'}
+            
+            # Add file info to result
+            result.update(file_info)
+            results[index] = result
+        
+        total_success = sum(1 for result in results if result['success'])
+        
+        return json_response({
             'success': total_success > 0,
             'batch_processing': True,
             'total_files': total_files,
@@ -231,85 +414,110 @@ def upload_file():
             
     except Exception as e:
         logger.error(f"Upload error: {str(e)}")
-        return jsonify({'success': False, 'error': str(e)})
+        return json_response({'success': False, 'error': str(e)})
 
-@app.route('/test-connection')
-def test_connection():
-    """Test TallyPrime connection"""
+@app.route('/upload-stream', methods=['POST'])
+async def upload_stream():
+    """Handle a single raw-body upload streamed straight to disk"""
     try:
-        import requests
-        config = get_config()
-        base_url = f"http://{config['tally_host']}:{config['tally_port']}"
+        # No multipart parsing: the body is the file, its name comes from the query/header
+        original_filename = request.args.get('filename') or request.headers.get('X-Filename', '')
+        if not original_filename or not allowed_file(original_filename):
+            return json_response({'success': False, 'error': f'Invalid file type: {original_filename}'})
         
-        response = requests.get(base_url, timeout=5)
+        filename = secure_filename(original_filename)
+        suffix = os.path.splitext(filename)[1]
         
-        if response.status_code == 200:
-            return jsonify({
-                'success': True,
-                'status': 'Connected',
-                'host': config['tally_host'],
-                'port': config['tally_port']
-            })
-        else:
-            return jsonify({
-                'success': False,
-                'status': 'Not responding',
-                'error': f'HTTP {response.status_code}'
-            })
+        file_path = None
+        try:
+            async with aiofiles.tempfile.NamedTemporaryFile('wb', dir=UPLOAD_FOLDER, suffix=suffix, delete=False,
+                                                            buffering=STREAM_CHUNK_SIZE) as out:
+                file_path = out.name
+                async for chunk in request.body:
+                    await out.write(chunk)
             
+            with open(file_path, 'rb') as stream:
+                result = await process_with_limit(stream, filename)
+            result['uploaded_file'] = os.path.basename(file_path)
+            result['original_filename'] = original_filename
+            result['file_size'] = os.path.getsize(file_path)
+        finally:
+            # Also covers a body that fails part-way (too large, client disconnect)
+            if file_path is not None:
+                os.remove(file_path)
+        
+        return json_response(result)
+    
+    except RequestEntityTooLarge as e:
+        logger.error(f"Stream upload rejected: {str(e)}")
+        return json_response({'success': False, 'error': str(e)}), 413
     except Exception as e:
-        return jsonify({
+        logger.error(f"Stream upload error: {str(e)}")
+        return json_response({'success': False, 'error': str(e)})
+
+@app.route('/test-connection')
+async def test_connection():
+    """Test TallyPrime connection"""
+    config = get_config()
+    status_code, error = await check_tally_connection()
+    
+    if status_code == 200:
+        return json_response({
+            'success': True,
+            'status': 'Connected',
+            'host': config['tally_host'],
+            'port': config['tally_port']
+        })
+    elif error is None:
+        return json_response({
+            'success': False,
+            'status': 'Not responding',
+            'error': f'HTTP {status_code}'
+        })
+    else:
+        return json_response({
             'success': False,
             'status': 'Connection failed',
-            'error': str(e)
+            'error': error
         })
 
 @app.route('/download/<path:filename>')
-def download_file(filename):
+async def download_file(filename):
     """Download generated files"""
     try:
         file_path = os.path.join(RESULTS_FOLDER, filename)
         if os.path.exists(file_path):
-            return send_file(file_path, as_attachment=True)
+            return await send_file(file_path, as_attachment=True)
         else:
-            return jsonify({'error': 'File not found'}), 404
+            return json_response({'error': 'File not found'}), 404
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}), 500
 
 @app.route('/history')
-def history():
+async def history():
     """Show processing history"""
     try:
-        results = []
-        results_dir = Path(RESULTS_FOLDER)
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = min(max(request.args.get('per_page', HISTORY_PER_PAGE, type=int), 1), HISTORY_MAX_PER_PAGE)
         
-        for json_file in results_dir.glob("invoice_*.json"):
-            try:
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                
-                # Get file info
-                stat = json_file.stat()
-                
-                results.append({
-                    'timestamp': datetime.fromtimestamp(stat.st_mtime).strftime("%Y-%m-%d %H:%M:%S"),
-                    'invoice_number': data.get('invoice_number', 'N/A'),
-                    'vendor_name': data.get('vendor_name', 'N/A'),
-                    'total_amount': data.get('total_amount', 0),
-                    'json_file': json_file.name,
-                    'xml_file': json_file.name.replace('invoice_', 'voucher_').replace('.json', '.xml')
-                })
-            except:
-                continue
+        # Newest first; only the index is read, never the result files themselves
+        entries = read_history_index()
+        total = len(entries)
+        end = total - (page - 1) * per_page
+        results = entries[max(end - per_page, 0):max(end, 0)][::-1]
         
-        # Sort by timestamp (newest first)
-        results.sort(key=lambda x: x['timestamp'], reverse=True)
+        # Summary cards cover every indexed invoice, not just this page
+        total_amount = sum(entry['total_amount'] for entry in entries
+                           if isinstance(entry.get('total_amount'), (int, float)))
+        vendor_count = len({entry.get('vendor_name') for entry in entries})
         
-        return render_template('history.html', results=results)
+        return await render_template('history.html', results=results, total=total, page=page,
+                                     per_page=per_page, pages=max(math.ceil(total / per_page), 1),
+                                     total_amount=total_amount, vendor_count=vendor_count)
         
     except Exception as e:
         logger.error(f"History error: {str(e)}")
-        return render_template('history.html', results=[], error=str(e))
+        return await render_template('history.html', results=[], error=str(e))
 
 if __name__ == '__main__':
     import os
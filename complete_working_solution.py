@@ -4,35 +4,147 @@ Complete Working Solution - Creates ledgers first, then vouchers
 """
 
 import requests
-import json
+from requests.adapters import HTTPAdapter
+import aiofiles
+import httpx
+import functools
+import io
+import os
+import orjson
 import re
+import tempfile
+from lxml import etree
 from pathlib import Path
-from config import validate_config
+from typing import AsyncIterator, Iterable, Iterator, List, Optional, Tuple
+from config import get_config, validate_config
 from invoice_processor import InvoiceProcessor
 import logging
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
+# Compiled once at import; these run for every ledger name and voucher field.
+# Control characters become spaces and the XML noncharacters U+FFFE/U+FFFF are dropped
+# (lxml rejects both); runs of whitespace are then collapsed.
+_TALLY_TRANS = str.maketrans({
+    '&': 'and', '<': None, '>': None, '"': None,
+    **{chr(code): ' ' for code in range(32)},
+    '\ufffe': None, '\uffff': None
+})
+_RE_WS = re.compile(r'\s+')
+_RE_SAFE = re.compile(r'[^\w\-]')
+
+# TallyPrime responses are parsed leniently and queried with precompiled XPaths
+_RESPONSE_PARSER = etree.XMLParser(recover=True)
+_XP_CREATED = etree.XPath('//CREATED/text()')
+_XP_LINEERROR = etree.XPath('//LINEERROR/text()')
+_XP_ERRORS = etree.XPath('//ERRORS/text()')
+_XP_EXCEPTIONS = etree.XPath('//EXCEPTIONS/text()')
+
+_XML_HEADERS = {'Content-Type': 'application/xml'}
+
+# Voucher XML is streamed to TallyPrime in blocks of about this many bytes
+XML_CHUNK_SIZE = 64 * 1024
+
+def _leaf(tag: str, text) -> etree._Element:
+    """Build a <tag>text</tag> element"""
+    element = etree.Element(tag)
+    element.text = str(text)
+    return element
+
+def _import_header() -> etree._Element:
+    """Build the <HEADER> of an Import Data request"""
+    header = etree.Element('HEADER')
+    header.append(_leaf('TALLYREQUEST', 'Import Data'))
+    return header
+
+def _request_desc(report_name: str) -> etree._Element:
+    """Build the <REQUESTDESC> naming the report to import into"""
+    request_desc = etree.Element('REQUESTDESC')
+    request_desc.append(_leaf('REPORTNAME', report_name))
+    return request_desc
+
+def _ledger_entry(ledger_name: str, deemed_positive: str, amount) -> etree._Element:
+    """Build one <ALLLEDGERENTRIES.LIST> voucher line"""
+    entry = etree.Element('ALLLEDGERENTRIES.LIST')
+    entry.append(_leaf('LEDGERNAME', ledger_name))
+    entry.append(_leaf('ISDEEMEDPOSITIVE', deemed_positive))
+    entry.append(_leaf('AMOUNT', amount))
+    return entry
+
+@functools.lru_cache(maxsize=4096)
+def _sanitize(text: str) -> str:
+    """Sanitize text for TallyPrime (memoized; ledger and party names repeat across invoices)"""
+    sanitized = text.strip().translate(_TALLY_TRANS)
+    sanitized = _RE_WS.sub(' ', sanitized)
+    
+    if len(sanitized) > 99:
+        sanitized = sanitized[:96] + "..."
+    
+    return sanitized or "Unknown"
+
+def _parse_response_root(content: bytes):
+    """Parse a TallyPrime response body, or return None if it isn't XML"""
+    try:
+        return etree.fromstring(content, _RESPONSE_PARSER)
+    except etree.XMLSyntaxError:
+        return None
+
+def _count(values: List[str]) -> int:
+    """Sum the numeric texts of a Tally count tag (CREATED, ERRORS, ...)"""
+    return sum(int(value) for value in values if value.strip().isdigit())
+
+def parse_tally_response(content: bytes) -> Tuple[int, List[str]]:
+    """Return (created count, line errors) from a TallyPrime response body"""
+    root = _parse_response_root(content)
+    
+    if root is None:
+        return 0, []
+    
+    return _count(_XP_CREATED(root)), [error.strip() for error in _XP_LINEERROR(root)]
+
+def ledgers_accepted(content: bytes, expected: int) -> bool:
+    """True only if TallyPrime created (or already had) all expected ledgers, with no other errors"""
+    root = _parse_response_root(content)
+    
+    # No import summary at all (empty body, "Unknown Request", ...) proves nothing
+    if root is None or not _XP_CREATED(root):
+        return False
+    
+    errors = [error.strip() for error in _XP_LINEERROR(root)]
+    duplicates = sum('already exists' in error.lower() for error in errors)
+    
+    # Duplicates may or may not be counted in ERRORS; anything beyond them is a real failure
+    if len(errors) > duplicates or _count(_XP_EXCEPTIONS(root)) or _count(_XP_ERRORS(root)) > duplicates:
+        return False
+    
+    return _count(_XP_CREATED(root)) + duplicates >= expected
+
 class CompleteTallyIntegration:
+    """TallyPrime client; safe to share across requests (settings are read once, restart to change them)"""
+    
     def __init__(self):
-        config = validate_config()
+        # Only the Tally settings are needed here, so a missing AI token is not an error
+        config = get_config()
         self.base_url = f"http://{config['tally_host']}:{config['tally_port']}"
+        
+        # Keep-alive connection pool reused for every ledger/voucher POST
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=8)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['Content-Type'] = 'application/xml'
+        
+        # Sanitized names TallyPrime has already accepted in this process; not sent again
+        self._known_ledgers = set()
     
     def sanitize_for_tally(self, text: str) -> str:
         """Sanitize text for TallyPrime"""
         if not text:
             return "Unknown"
         
-        sanitized = str(text).strip()
-        sanitized = sanitized.replace('&', 'and')
-        sanitized = re.sub(r'[<>"]', '', sanitized)
-        sanitized = re.sub(r'\s+', ' ', sanitized)
-        
-        if len(sanitized) > 99:
-            sanitized = sanitized[:96] + "..."
-        
-        return sanitized or "Unknown"
+        # Coerce first so the cache key is always a hashable str
+        return _sanitize(str(text))
     
     def format_tally_date(self, date_str: str) -> str:
         """Format date for TallyPrime - Try DDMMYYYY format"""
@@ -51,73 +163,122 @@ class CompleteTallyIntegration:
     
     def create_ledger(self, ledger_name: str, parent_group: str) -> bool:
         """Create a single ledger"""
+        return self.create_ledgers([(ledger_name, parent_group)])
+    
+    def create_ledgers(self, ledgers: List[Tuple[str, str]]) -> bool:
+        """Create several ledgers with one ImportData request (one TALLYMESSAGE each)"""
         
-        clean_name = self.sanitize_for_tally(ledger_name)
-        
-        xml = f"""<?xml version="1.0" encoding="UTF-8"?>
-<ENVELOPE>
-    <HEADER>
-        <TALLYREQUEST>Import Data</TALLYREQUEST>
-    </HEADER>
-    <BODY>
-        <IMPORTDATA>
-            <REQUESTDESC>
-                <REPORTNAME>All Masters</REPORTNAME>
-            </REQUESTDESC>
-            <REQUESTDATA>
-                <TALLYMESSAGE xmlns:UDF="TallyUDF">
-                    <LEDGER NAME="{clean_name}" ACTION="Create">
-                        <NAME>{clean_name}</NAME>
-                        <PARENT>{parent_group}</PARENT>
-                        <ISBILLWISEON>{"Yes" if parent_group == "Sundry Creditors" else "No"}</ISBILLWISEON>
-                    </LEDGER>
-                </TALLYMESSAGE>
-            </REQUESTDATA>
-        </IMPORTDATA>
-    </BODY>
-</ENVELOPE>"""
+        unique = self._unique_ledgers(ledgers)
+        if not unique:
+            print("   ✅ Ledgers already exist, nothing to create")
+            return True
         
         try:
-            response = requests.post(
-                self.base_url,
-                data=xml,
-                headers={'Content-Type': 'application/xml'},
-                timeout=15
-            )
-            
-            if response.status_code == 200:
-                print(f"   ✅ Ledger created: {clean_name}")
-                return True
-            else:
-                print(f"   ⚠️  Ledger creation issue: {clean_name}")
-                return False
-                
+            response = self.session.post(self.base_url, data=self.build_ledgers_xml(unique), timeout=15)
+            return self._check_ledger_response(response, unique)
         except Exception as e:
-            print(f"   ❌ Error creating ledger {clean_name}: {str(e)}")
+            print(f"   ❌ Error creating ledgers {', '.join(unique)}: {str(e)}")
             return False
     
-    def create_all_required_ledgers(self, invoice_data: dict) -> bool:
-        """Create all ledgers needed for the invoice"""
+    async def create_ledgers_async(self, ledgers: List[Tuple[str, str]], client: httpx.AsyncClient) -> bool:
+        """Async variant of create_ledgers over a shared httpx client"""
         
-        print("   🏗️  Creating required ledgers...")
+        unique = self._unique_ledgers(ledgers)
+        if not unique:
+            print("   ✅ Ledgers already exist, nothing to create")
+            return True
         
-        # Create vendor ledger
-        vendor_name = invoice_data.get('vendor_name', 'Unknown Vendor')
-        self.create_ledger(vendor_name, "Sundry Creditors")
+        try:
+            response = await client.post(self.base_url, content=self.build_ledgers_xml(unique),
+                                         headers=_XML_HEADERS, timeout=15)
+            return self._check_ledger_response(response, unique)
+        except Exception as e:
+            print(f"   ❌ Error creating ledgers {', '.join(unique)}: {str(e)}")
+            return False
+    
+    def _unique_ledgers(self, ledgers: List[Tuple[str, str]]) -> dict:
+        """Sanitize names once and drop duplicates and known ledgers, keeping the first parent group seen"""
+        unique = {}
+        for ledger_name, parent_group in ledgers:
+            clean_name = self.sanitize_for_tally(ledger_name)
+            if clean_name not in self._known_ledgers:
+                unique.setdefault(clean_name, parent_group)
+        return unique
+    
+    def build_ledgers_xml(self, unique: dict) -> bytes:
+        """Build one All Masters envelope creating every sanitized ledger in unique"""
+        
+        envelope = etree.Element('ENVELOPE')
+        envelope.append(_import_header())
+        import_data = etree.SubElement(etree.SubElement(envelope, 'BODY'), 'IMPORTDATA')
+        import_data.append(_request_desc('All Masters'))
+        request_data = etree.SubElement(import_data, 'REQUESTDATA')
+        
+        for clean_name, parent_group in unique.items():
+            message = etree.SubElement(request_data, 'TALLYMESSAGE', nsmap={'UDF': 'TallyUDF'})
+            ledger = etree.SubElement(message, 'LEDGER', NAME=clean_name, ACTION='Create')
+            ledger.append(_leaf('NAME', clean_name))
+            ledger.append(_leaf('PARENT', parent_group))
+            ledger.append(_leaf('ISBILLWISEON', "Yes" if parent_group == "Sundry Creditors" else "No"))
+        
+        return etree.tostring(envelope, xml_declaration=True, encoding='UTF-8')
+    
+    def _check_ledger_response(self, response, unique: dict) -> bool:
+        """Report the outcome of a ledger batch (requests or httpx response)"""
         
-        # Create purchase account ledger
-        self.create_ledger("Purchase Account", "Purchase Accounts")
+        names = ', '.join(unique)
         
-        # Create item-specific ledgers if needed
+        if response.status_code == 200:
+            created, errors = parse_tally_response(response.content)
+            print(f"   ✅ Ledgers submitted: {len(unique)} ({created} created): {names}")
+            
+            # Remember the batch only once Tally has accepted every ledger in it
+            if ledgers_accepted(response.content, len(unique)):
+                self._known_ledgers.update(unique)
+            return True
+        else:
+            print(f"   ⚠️  Ledger creation issue: {names}")
+            return False
+    
+    def required_ledgers(self, invoice_data: dict) -> List[Tuple[str, str]]:
+        """List the (ledger name, parent group) pairs the invoice needs"""
+        
+        # Vendor ledger and purchase account ledger
+        vendor_name = invoice_data.get('vendor_name', 'Unknown Vendor')
+        ledgers = [
+            (vendor_name, "Sundry Creditors"),
+            ("Purchase Account", "Purchase Accounts")
+        ]
+        
+        # Item-specific ledgers if needed
         for item in invoice_data.get('line_items', []):
             item_name = item.get('description', 'Purchase Item')
             if item_name and item_name != 'Purchase Account':
-                self.create_ledger(item_name, "Purchase Accounts")
+                ledgers.append((item_name, "Purchase Accounts"))
+        
+        return ledgers
+    
+    def create_all_required_ledgers(self, invoice_data: dict) -> bool:
+        """Create all ledgers needed for the invoice"""
+        
+        print("   🏗️  Creating required ledgers...")
+        
+        # Single round-trip for every ledger
+        return self.create_ledgers(self.required_ledgers(invoice_data))
+    
+    async def create_all_required_ledgers_async(self, invoice_data: dict, client: httpx.AsyncClient) -> bool:
+        """Async variant of create_all_required_ledgers"""
         
-        return True
+        print("   🏗️  Creating required ledgers...")
+        
+        return await self.create_ledgers_async(self.required_ledgers(invoice_data), client)
     
     def create_voucher(self, invoice_data: dict) -> str:
         """Create voucher XML"""
+        return b''.join(self.iter_voucher_xml(invoice_data)).decode('utf-8')
+    
+    def iter_voucher_xml(self, invoice_data: dict) -> Iterator[bytes]:
+        """Yield UTF-8 voucher XML in blocks of roughly XML_CHUNK_SIZE bytes"""
         
         vendor = self.sanitize_for_tally(invoice_data.get('vendor_name', 'Unknown Vendor'))
         invoice_num = self.sanitize_for_tally(invoice_data.get('invoice_number', 'INV001'))
@@ -131,60 +292,93 @@ class CompleteTallyIntegration:
         line_items = invoice_data.get('line_items', [])
         line_items_total = sum(float(item.get('amount', 0.0)) for item in line_items)
         
-        xml = f"""<?xml version="1.0" encoding="UTF-8"?>
-<ENVELOPE>
-    <HEADER>
-        <TALLYREQUEST>Import Data</TALLYREQUEST>
-    </HEADER>
-    <BODY>
-        <IMPORTDATA>
-            <REQUESTDESC>
-                <REPORTNAME>Vouchers</REPORTNAME>
-            </REQUESTDESC>
-            <REQUESTDATA>
-                <TALLYMESSAGE xmlns:UDF="TallyUDF">
-                    <VOUCHER REMOTEID="" VCHKEY="" VCHTYPE="Purchase" ACTION="Create">
-                        <DATE>{date}</DATE>
-                        <VOUCHERTYPENAME>Purchase</VOUCHERTYPENAME>
-                        <VOUCHERNUMBER>{invoice_num}</VOUCHERNUMBER>
-                        <PARTYLEDGERNAME>{vendor}</PARTYLEDGERNAME>
-                        <ALLLEDGERENTRIES.LIST>
-                            <LEDGERNAME>{vendor}</LEDGERNAME>
-                            <ISDEEMEDPOSITIVE>No</ISDEEMEDPOSITIVE>
-                            <AMOUNT>-{total_amount}</AMOUNT>
-                        </ALLLEDGERENTRIES.LIST>"""
-        
         # Add line items or single purchase account
         if line_items and abs(line_items_total - total_amount) < 1.0:
             # Use individual line items
-            for item in line_items:
-                item_name = self.sanitize_for_tally(item.get('description', 'Purchase Account'))
-                item_amount = float(item.get('amount', 0.0))
-                
-                xml += f"""
-                        <ALLLEDGERENTRIES.LIST>
-                            <LEDGERNAME>{item_name}</LEDGERNAME>
-                            <ISDEEMEDPOSITIVE>Yes</ISDEEMEDPOSITIVE>
-                            <AMOUNT>{item_amount}</AMOUNT>
-                        </ALLLEDGERENTRIES.LIST>"""
+            entries = (
+                (self.sanitize_for_tally(item.get('description', 'Purchase Account')), float(item.get('amount', 0.0)))
+                for item in line_items
+            )
         else:
             # Use single purchase account
-            xml += f"""
-                        <ALLLEDGERENTRIES.LIST>
-                            <LEDGERNAME>Purchase Account</LEDGERNAME>
-                            <ISDEEMEDPOSITIVE>Yes</ISDEEMEDPOSITIVE>
-                            <AMOUNT>{total_amount}</AMOUNT>
-                        </ALLLEDGERENTRIES.LIST>"""
-        
-        xml += """
-                    </VOUCHER>
-                </TALLYMESSAGE>
-            </REQUESTDATA>
-        </IMPORTDATA>
-    </BODY>
-</ENVELOPE>"""
-        
-        return xml
+            entries = [("Purchase Account", total_amount)]
+        
+        # lxml writes the envelope incrementally into buf (escaping every value);
+        # buf is handed out whenever it grows past XML_CHUNK_SIZE
+        buf = io.BytesIO()
+        with etree.xmlfile(buf, encoding='UTF-8', buffered=False) as xf:
+            xf.write_declaration()
+            with xf.element('ENVELOPE'):
+                xf.write(_import_header())
+                with xf.element('BODY'), xf.element('IMPORTDATA'):
+                    xf.write(_request_desc('Vouchers'))
+                    with xf.element('REQUESTDATA'), \
+                            xf.element('TALLYMESSAGE', nsmap={'UDF': 'TallyUDF'}), \
+                            xf.element('VOUCHER', {'REMOTEID': '', 'VCHKEY': '', 'VCHTYPE': 'Purchase', 'ACTION': 'Create'}):
+                        xf.write(_leaf('DATE', date))
+                        xf.write(_leaf('VOUCHERTYPENAME', 'Purchase'))
+                        xf.write(_leaf('VOUCHERNUMBER', invoice_num))
+                        xf.write(_leaf('PARTYLEDGERNAME', vendor))
+                        xf.write(_ledger_entry(vendor, 'No', f"-{total_amount}"))
+                        
+                        for item_name, item_amount in entries:
+                            xf.write(_ledger_entry(item_name, 'Yes', item_amount))
+                            
+                            if buf.tell() >= XML_CHUNK_SIZE:
+                                yield buf.getvalue()
+                                buf.seek(0)
+                                buf.truncate()
+        
+        yield buf.getvalue()
+    
+    @staticmethod
+    def _tee_to_file(chunks: Iterable[bytes], f, result: dict, path: str) -> Iterator[bytes]:
+        """Write each XML chunk to f and pass it on as the request body; path becomes result['xml_file'] once complete"""
+        for chunk in chunks:
+            f.write(chunk)
+            yield chunk
+        result['xml_file'] = path
+    
+    @staticmethod
+    async def _atee_to_file(chunks: Iterable[bytes], f, result: dict, path: str) -> AsyncIterator[bytes]:
+        """Async variant of _tee_to_file for an aiofiles handle"""
+        for chunk in chunks:
+            await f.write(chunk)
+            yield chunk
+        result['xml_file'] = path
+    
+    @staticmethod
+    def _discard_partial_xml(result: dict, xml_filename: Optional[str]) -> None:
+        """Remove the saved voucher copy if generation failed before it was complete"""
+        if xml_filename and result['xml_file'] is None and os.path.exists(xml_filename):
+            os.remove(xml_filename)
+    
+    @staticmethod
+    def _voucher_xml_path(voucher_number) -> str:
+        """Create a uniquely named file in /tmp/ for the saved voucher XML copy and return its path"""
+        safe_name = _RE_SAFE.sub('_', str(voucher_number))
+        # Concurrent imports of the same voucher number each get their own file
+        fd, path = tempfile.mkstemp(prefix=f"complete_{safe_name}_", suffix=".xml")
+        os.close(fd)
+        return path
+    
+    def _apply_voucher_response(self, result: dict, response) -> None:
+        """Record the voucher import outcome (requests or httpx response) in result"""
+        
+        if response.status_code == 200:
+            created, errors = parse_tally_response(response.content)
+            if created:
+                result['success'] = True
+                print(f"   ✅ Voucher imported successfully!")
+            elif errors:
+                result['error'] = f"TallyPrime: {errors[0]}"
+                print(f"   ❌ {result['error']}")
+            else:
+                result['success'] = True
+                print(f"   ✅ Import completed!")
+        else:
+            result['error'] = f"HTTP {response.status_code}"
+            print(f"   ❌ HTTP Error: {response.status_code}")
     
     def import_complete_invoice(self, invoice_data: dict) -> dict:
         """Complete import process: ledgers first, then voucher"""
@@ -196,54 +390,80 @@ class CompleteTallyIntegration:
             'voucher_number': invoice_data.get('invoice_number', 'Unknown')
         }
         
+        xml_filename = None
         try:
             print(f"   📊 Processing invoice: {result['voucher_number']}")
             
             # Step 1: Create all required ledgers
             self.create_all_required_ledgers(invoice_data)
             
-            # Step 2: Create voucher XML
-            xml_content = self.create_voucher(invoice_data)
+            # Step 2: Stream voucher XML to TallyPrime, saving it in /tmp/ as it is sent
+            xml_filename = self._voucher_xml_path(result['voucher_number'])
+            
+            print(f"   📤 Importing voucher to TallyPrime...")
+            
+            with open(xml_filename, 'wb') as f:
+                body = self._tee_to_file(self.iter_voucher_xml(invoice_data), f, result, xml_filename)
+                try:
+                    # A generator body is sent with chunked transfer encoding
+                    response = self.session.post(self.base_url, data=body, timeout=20)
+                finally:
+                    # Finish the saved copy even if TallyPrime was unreachable
+                    for _ in body:
+                        pass
+            
+            self._apply_voucher_response(result, response)
+                
+        except Exception as e:
+            result['error'] = f"Exception: {str(e)}"
+            print(f"   ❌ Exception: {str(e)}")
+            self._discard_partial_xml(result, xml_filename)
+        
+        return result
+    
+    async def import_complete_invoice_async(self, invoice_data: dict,
+                                            client: Optional[httpx.AsyncClient] = None) -> dict:
+        """Async variant of import_complete_invoice over httpx (one client per call if none given)"""
+        
+        if client is None:
+            async with httpx.AsyncClient(http2=True, timeout=15) as client:
+                return await self.import_complete_invoice_async(invoice_data, client)
+        
+        result = {
+            'success': False,
+            'xml_file': None,
+            'error': None,
+            'voucher_number': invoice_data.get('invoice_number', 'Unknown')
+        }
+        
+        xml_filename = None
+        try:
+            print(f"   📊 Processing invoice: {result['voucher_number']}")
             
-            # Step 3: Save XML in /tmp/
-            safe_name = re.sub(r'[^\w\-]', '_', str(result['voucher_number']))
-            xml_filename = f"/tmp/complete_{safe_name}.xml"
+            # Step 1: Create all required ledgers
+            await self.create_all_required_ledgers_async(invoice_data, client)
             
-            with open(xml_filename, 'w', encoding='utf-8') as f:
-                f.write(xml_content)
-            result['xml_file'] = xml_filename
+            # Step 2: Stream voucher XML to TallyPrime, saving it in /tmp/ as it is sent
+            xml_filename = self._voucher_xml_path(result['voucher_number'])
             
-            # Step 4: Import voucher
             print(f"   📤 Importing voucher to TallyPrime...")
             
-            response = requests.post(
-                self.base_url,
-                data=xml_content,
-                headers={'Content-Type': 'application/xml'},
-                timeout=20
-            )
+            async with aiofiles.open(xml_filename, 'wb') as f:
+                body = self._atee_to_file(self.iter_voucher_xml(invoice_data), f, result, xml_filename)
+                try:
+                    # An async iterator body is sent with chunked transfer encoding
+                    response = await client.post(self.base_url, content=body, headers=_XML_HEADERS, timeout=20)
+                finally:
+                    # Finish the saved copy even if TallyPrime was unreachable
+                    async for _ in body:
+                        pass
             
-            if response.status_code == 200:
-                if '<CREATED>1</CREATED>' in response.text:
-                    result['success'] = True
-                    print(f"   ✅ Voucher imported successfully!")
-                elif 'LINEERROR' in response.text:
-                    error_match = re.search(r'<LINEERROR>(.*?)</LINEERROR>', response.text)
-                    if error_match:
-                        result['error'] = f"TallyPrime: {error_match.group(1)}"
-                    else:
-                        result['error'] = "TallyPrime reported an error"
-                    print(f"   ❌ {result['error']}")
-                else:
-                    result['success'] = True
-                    print(f"   ✅ Import completed!")
-            else:
-                result['error'] = f"HTTP {response.status_code}"
-                print(f"   ❌ HTTP Error: {response.status_code}")
+            self._apply_voucher_response(result, response)
                 
         except Exception as e:
             result['error'] = f"Exception: {str(e)}"
             print(f"   ❌ Exception: {str(e)}")
+            self._discard_partial_xml(result, xml_filename)
         
         return result
 
@@ -259,10 +479,10 @@ def complete_workflow(invoice_file: str) -> dict:
         # Step 1: AI Processing
         print("🤖 Step 1: AI Processing with LLAMA Maverick...")
         config = validate_config()
-        processor = InvoiceProcessor(config['deepinfra_token'])
-        
-        json_results = processor.process_invoice_file(invoice_file)
-        merged_json = processor.merge_json_data(json_results)
+        with InvoiceProcessor(config['deepinfra_token'], rpm=config['llm_rpm'], tpm=config['llm_tpm'],
+                              batch_size=config['llm_batch_size']) as processor:
+            json_results = processor.process_invoice_file(invoice_file)
+            merged_json = processor.merge_json_data(json_results)
         
         print(f"   ✅ Processed {len(json_results)} page(s)")
         print(f"   📊 Invoice: {merged_json.get('invoice_number')}")
@@ -270,9 +490,9 @@ def complete_workflow(invoice_file: str) -> dict:
         print(f"   💰 Amount: ₹{merged_json.get('total_amount')}")
         
         # Save JSON in /tmp/
-        json_file = f"/tmp/{Path(invoice_file).stem}_complete.json"
-        with open(json_file, 'w', encoding='utf-8') as f:
-            json.dump(merged_json, f, indent=2, ensure_ascii=False)
+        fd, json_file = tempfile.mkstemp(prefix=f"{Path(invoice_file).stem}_", suffix="_complete.json")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(orjson.dumps(merged_json, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
         
         # Step 2: TallyPrime Integration
         print("\n🔄 Step 2: TallyPrime Integration...")
@@ -5,9 +5,10 @@ Configuration management for the invoice processing workflow
 
 import os
 from pathlib import Path
+from types import MappingProxyType
 
 def load_env_file():
-    """Load environment variables from .env file"""
+    """Load environment variables from .env file (variables already set in the environment win)"""
     env_file = Path('.env')
     if env_file.exists():
         with open(env_file, 'r') as f:
@@ -15,31 +16,38 @@ def load_env_file():
                 line = line.strip()
                 if line and not line.startswith('#') and '=' in line:
                     key, value = line.split('=', 1)
-                    os.environ[key.strip()] = value.strip()
+                    os.environ.setdefault(key.strip(), value.strip())
 
-def get_config():
-    """Get configuration from environment variables"""
-    # Load .env file first
-    load_env_file()
-    
-    config = {
+def _build_config():
+    """Read configuration from environment variables"""
+    return MappingProxyType({
         'deepinfra_token': os.getenv('DEEPINFRA_TOKEN'),
         'tally_host': os.getenv('TALLY_HOST', 'localhost'),
         'tally_port': int(os.getenv('TALLY_PORT', '9000')),
-        'company_name': os.getenv('COMPANY_NAME', 'Default Company')
-    }
-    
-    return config
+        'company_name': os.getenv('COMPANY_NAME', 'Default Company'),
+        'max_concurrent': int(os.getenv('MAX_CONCURRENT', '4')),
+        'max_upload_mb': int(os.getenv('MAX_UPLOAD_MB', '100')),
+        'llm_rpm': int(os.getenv('LLM_RPM', '0')),
+        'llm_tpm': int(os.getenv('LLM_TPM', '0')),
+        'llm_batch_size': int(os.getenv('LLM_BATCH_SIZE', '1')),
+        'cache_dir': os.getenv('CACHE_DIR', '/tmp/invoice_cache')
+    })
+
+def get_config():
+    """Get configuration (read-only, loaded once at import)"""
+    return _CONFIG
 
 def validate_config():
     """Validate that required configuration is present"""
-    config = get_config()
-    
-    if not config['deepinfra_token']:
+    if not _CONFIG['deepinfra_token']:
         raise ValueError(
             "DEEPINFRA_TOKEN not found. Please:\n"
             "1. Set it in .env file, or\n"
             "2. Set environment variable: export DEEPINFRA_TOKEN=your_token"
         )
-    
-    return config
\ No newline at end of file
+
+    return _CONFIG
+
+# Parse .env and the environment once per process; restart to pick up changes
+load_env_file()
+_CONFIG = _build_config()
@@ -5,105 +5,803 @@ Processes invoice images/PDFs -> JSON -> Tally XML -> TallyPrime integration
 """
 
 import os
+import re
+import copy
 import json
+import math
+import asyncio
+import multiprocessing
+import threading
+import time
+from itertools import chain
 import base64
-import requests
-from typing import List, Dict, Any, Optional
+import hashlib
+import tempfile
+import httpx
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Optional, Tuple
 from pathlib import Path
 import logging
+from lxml import etree
+from lxml.builder import ElementMaker
+
+# orjson parses and encodes several times faster; the stdlib is the fallback
+try:
+    import orjson
+    
+    _json_loads = orjson.loads
+    
+    def _json_dumps(obj, indent: bool = False) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+except ImportError:
+    _json_loads = json.loads
+    
+    def _json_dumps(obj, indent: bool = False) -> bytes:
+        return json.dumps(obj, indent=2 if indent else None).encode('utf-8')
+
+# ciso8601 parses ISO dates in C; datetime.fromisoformat is the fallback
+try:
+    from ciso8601 import parse_datetime as _parse_iso
+except ImportError:
+    _parse_iso = datetime.fromisoformat
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Invoice date formats tried in order after the ISO fast path
+_DATE_FORMATS = ('%d-%b-%Y', '%d-%m-%Y', '%d-%m-%y', '%Y-%m-%d')
+
+def _parse_date(value: Any) -> datetime:
+    """Parse an extracted invoice date, falling back to today when it can't be read"""
+    if not isinstance(value, str) or not value:
+        return datetime.now()
+    value = value.strip()
+    try:
+        return _parse_iso(value)
+    except ValueError:
+        pass
+    for fmt in _DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    return datetime.now()
+
+# Built once at import instead of on every LLM call
+_EXTRACTION_SCHEMA = """{
+    "invoice_number": "",
+    "date": "",
+    "vendor_name": "",
+    "vendor_address": "",
+    "total_amount": 0.0,
+    "tax_amount": 0.0,
+    "line_items": [
+        {
+            "description": "",
+            "quantity": 0,
+            "rate": 0.0,
+            "amount": 0.0
+        }
+    ]
+}"""
+_EXTRACTION_PROMPT = "Extract invoice data and return as JSON with this structure:\n" + _EXTRACTION_SCHEMA
+# Formatted with the image count, then followed by _EXTRACTION_SCHEMA
+_BATCH_PROMPT_HEAD = ("Extract invoice data for each of the following {count} images. Return a JSON array of exactly "
+                      "{count} objects, one per image in the order given, each with this structure:\n")
+_HEADERS_BASE = {"Content-Type": "application/json"}
+_JSON_BLOCK_RE = re.compile(r'```json\n(.*?)\n```', re.DOTALL)
+_JSON_BRACE_RE = re.compile(r'\{.*\}', re.DOTALL)
+_JSON_ARRAY_RE = re.compile(r'\[.*\]', re.DOTALL)
+
+# Bump whenever the extraction prompt or expected schema changes, so cached answers are not reused
+PROMPT_VERSION = "2"
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "invoice_processor"
+
+# Timeout and pool limits used by both LLM clients (the processor's sync client and each PDF's async client)
+LLM_TIMEOUT = 60.0
+LLM_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+
+# Invalid extractions are sent back to the model with the error this many times
+REPAIR_RETRIES = 2
+
+def _as_number(value, field: str):
+    """Return value as a number, converting numeric strings like "1,234.50"; raise ValueError otherwise"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        try:
+            return float(value.replace(',', '').strip())
+        except ValueError:
+            pass
+    raise ValueError(f"{field} must be a number, got {value!r}")
+
+def _validate_extraction(data) -> None:
+    """Raise ValueError if data lacks the shape the Tally steps rely on (see _EXTRACTION_SCHEMA)
+    
+    Numeric strings are accepted and converted to numbers in place; a null or empty tax_amount
+    (often how a model reports "no tax") becomes 0.0.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("expected a JSON object")
+    
+    tax_amount = data.get('tax_amount', 0.0)
+    if tax_amount is None or (isinstance(tax_amount, str) and not tax_amount.strip()):
+        data['tax_amount'] = 0.0
+    
+    for field in ('total_amount', 'tax_amount'):
+        if field in data:
+            data[field] = _as_number(data[field], f"'{field}'")
+    
+    line_items = data.get('line_items', [])
+    if not isinstance(line_items, list):
+        raise ValueError("'line_items' must be an array")
+    for index, item in enumerate(line_items):
+        if not isinstance(item, dict):
+            raise ValueError(f"line_items[{index}] must be an object")
+        if 'amount' in item:
+            item['amount'] = _as_number(item['amount'], f"line_items[{index}].amount")
+
+# Rate limiting: 429s are retried this many times; vision input is costed at a flat per-image estimate
+RATE_LIMIT_RETRIES = 3
+IMAGE_TOKEN_ESTIMATE = 1500
+_DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+_DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+def _parse_duration(value: Optional[str]) -> Optional[float]:
+    """Seconds from a rate-limit header value such as '2', '1.5s', '20ms' or '6m0s'"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_RE.findall(value)
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts) if parts else None
+
+class RateLimiter:
+    """Token-bucket pacing of LLM calls by requests and tokens per minute (0 = unlimited)
+    
+    Thread-safe and not tied to an event loop, so one limiter covers the sync client and
+    every per-PDF async loop of a processor.
+    """
+    
+    def __init__(self, rpm: int = 0, tpm: int = 0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._lock = threading.Lock()
+        # Buckets hold about one second of budget, so calls are spread out instead of bursting
+        self._request_capacity = max(1.0, rpm / 60)
+        self._token_capacity = max(1.0, tpm / 60)
+        self._request_budget = self._request_capacity
+        self._token_budget = self._token_capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+    
+    def _reserve(self, tokens: int) -> float:
+        """Take one request and `tokens` from the buckets; return how long the caller must wait"""
+        with self._lock:
+            now = time.monotonic()
+            elapsed, self._updated = now - self._updated, now
+            wait = 0.0
+            
+            # Budgets may go negative: later callers then queue behind earlier reservations
+            if self.rpm:
+                rate = self.rpm / 60
+                self._request_budget = min(self._request_capacity, self._request_budget + elapsed * rate) - 1
+                if self._request_budget < 0:
+                    wait = -self._request_budget / rate
+            
+            if self.tpm:
+                rate = self.tpm / 60
+                self._token_budget = min(self._token_capacity, self._token_budget + elapsed * rate) - tokens
+                if self._token_budget < 0:
+                    wait = max(wait, -self._token_budget / rate)
+            
+            return max(wait, self._paused_until - now)
+    
+    def _pause_remaining(self) -> float:
+        """Seconds left of a pause imposed by the provider"""
+        with self._lock:
+            return self._paused_until - time.monotonic()
+    
+    def acquire(self, tokens: int = 0) -> None:
+        """Block until a request costing `tokens` may be sent"""
+        delay = self._reserve(tokens)
+        while delay > 0:
+            time.sleep(delay)
+            # A 429 elsewhere may have paused everyone while we slept
+            delay = self._pause_remaining()
+    
+    async def acquire_async(self, tokens: int = 0) -> None:
+        """Async variant of acquire"""
+        delay = self._reserve(tokens)
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self._pause_remaining()
+    
+    def pause(self, seconds: float) -> None:
+        """Hold back every new request for `seconds`"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+    
+    def update_from_headers(self, headers) -> None:
+        """Pause until the provider's window resets once its x-ratelimit-remaining-* budget is spent"""
+        for limit in ('requests', 'tokens'):
+            remaining = _parse_duration(headers.get(f'x-ratelimit-remaining-{limit}'))
+            if remaining is not None and remaining <= 0:
+                self.pause(_parse_duration(headers.get(f'x-ratelimit-reset-{limit}')) or 1.0)
+    
+    @staticmethod
+    def retry_delay(headers, attempt: int) -> float:
+        """Seconds to wait before retrying a 429: Retry-After if given, else exponential backoff"""
+        return _parse_duration(headers.get('retry-after')) or float(2 ** attempt)
+
+# Page rendering: a vision model gains nothing past ~150 DPI, and JPEG pages are several times smaller than PNG.
+# PDFs with at least PARALLEL_RENDER_MIN_PAGES pages are split across processes
+RENDER_DPI = 150
+JPEG_QUALITY = 85
+PARALLEL_RENDER_MIN_PAGES = 8
+
+# Data-URL MIME type by file signature (uploaded images may be PNG or JPEG)
+_IMAGE_SIGNATURES = (
+    (b'\x89PNG', 'image/png'),
+    (b'\xff\xd8', 'image/jpeg'),
+    (b'GIF8', 'image/gif'),
+)
+
+def _image_mime(image_bytes: bytes) -> str:
+    """MIME type of an encoded image, defaulting to JPEG"""
+    for signature, mime in _IMAGE_SIGNATURES:
+        if image_bytes.startswith(signature):
+            return mime
+    if image_bytes[:4] == b'RIFF' and image_bytes[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'image/jpeg'
+
+# PyMuPDF is imported on first PDF (image-only and CLI runs never pay for it), then kept here
+_fitz = None
+
+def _import_fitz():
+    """Import PyMuPDF, which is only needed for PDFs"""
+    global _fitz
+    if _fitz is None:
+        try:
+            import fitz  # PyMuPDF
+        except ImportError:
+            raise ImportError("PyMuPDF is required for PDF processing. Install with: pip install PyMuPDF")
+        _fitz = fitz
+    return _fitz
+
+def _open_pdf(source):
+    """Open a PDF from a path or from its bytes"""
+    fitz = _import_fitz()
+    if isinstance(source, bytes):
+        return fitz.open(stream=source, filetype='pdf')
+    return fitz.open(source)
+
+def _render_pages(doc, start: int, stop: int, dpi: int, jpeg_quality: int) -> List[tuple]:
+    """Render pages [start, stop) of an open document as (page number, JPEG bytes)"""
+    return [(page_num, doc.load_page(page_num).get_pixmap(dpi=dpi, alpha=False).tobytes("jpeg", jpg_quality=jpeg_quality))
+            for page_num in range(start, stop)]
+
+def _render_segment(args) -> List[tuple]:
+    """Pool worker: open the PDF itself (documents can't be shared) and render its slice of pages"""
+    seg_idx, n_workers, source, dpi, jpeg_quality = args
+    doc = _open_pdf(source)
+    try:
+        num_pages = len(doc)
+        seg_size = math.ceil(num_pages / n_workers)
+        start = seg_idx * seg_size
+        return _render_pages(doc, start, min(start + seg_size, num_pages), dpi, jpeg_quality)
+    finally:
+        doc.close()
+
+class ExtractionCache:
+    """On-disk cache of LLM extractions, one JSON file per key"""
+    
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.cache_dir = Path(cache_dir)
+    
+    @staticmethod
+    def make_key(*parts: bytes) -> str:
+        """SHA-256 over length-prefixed parts, so no two different part lists hash the same input"""
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(len(part).to_bytes(8, 'big'))
+            digest.update(part)
+        return digest.hexdigest()
+    
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return the cached extraction for key, or None"""
+        try:
+            with open(self.cache_dir / f"{key}.json", 'rb') as f:
+                return _json_loads(f.read())['result']
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable cache entry {key}: {str(e)}")
+            return None
+    
+    def set(self, key: str, value: Dict[str, Any]) -> None:
+        """Store an extraction under key (failures are logged, never raised)"""
+        entry = {'cached_at': datetime.now(timezone.utc).isoformat(), 'result': value}
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            # Write then rename, so concurrent readers never see half an entry
+            tmp_path = self.cache_dir / f"{key}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(_json_dumps(entry))
+            os.replace(tmp_path, self.cache_dir / f"{key}.json")
+        except Exception as e:
+            logger.warning(f"Could not write cache entry {key}: {str(e)}")
+
+# Fixed voucher fields as (tag, value), in emitted order; EFFECTIVEDATE goes between the two runs
+_VOUCHER_FLAGS_HEAD = (
+    ("DIFFACTUALQTY", "No"),
+    ("ISMSTFROMSYNC", "No"),
+    ("ASORIGINAL", "No"),
+    ("AUDITED", "No"),
+    ("FORJOBCOSTING", "No"),
+    ("ISOPTIONAL", "No"),
+)
+
+_VOUCHER_FLAGS_TAIL = (
+    ("USEFOREXCISE", "No"),
+    ("ISFORJOBWORKIN", "No"),
+    ("ALLOWCONSUMPTION", "No"),
+    ("USEFORINTEREST", "No"),
+    ("USEFORGAINLOSS", "No"),
+    ("USEFORGODOWNTRANSFER", "No"),
+    ("USEFORCOMPOUND", "No"),
+    ("USEFORSERVICETAX", "No"),
+    ("ISEXCISEVOUCHER", "No"),
+    ("EXCISETAXOVERRIDE", "No"),
+    ("USEFORTAXUNITTRANSFER", "No"),
+    ("IGNOREPOSVALIDATION", "No"),
+    ("EXCISEOPENING", "No"),
+    ("USEFORFINALPRODUCTION", "No"),
+    ("ISTDSOVERRIDDEN", "No"),
+    ("ISTCSOVERRIDDEN", "No"),
+    ("ISTDSTCSCASHVCH", "No"),
+    ("INCLUDEADVPYMTVCH", "No"),
+    ("ISSUBWORKSCONTRACT", "No"),
+    ("ISVATOVERRIDDEN", "No"),
+    ("IGNOREORIGVCHDATE", "No"),
+    ("ISVATPAIDATCUSTOMS", "No"),
+    ("ISDECLAREDTOCUSTOMS", "No"),
+    ("ISSERVICETAXOVERRIDDEN", "No"),
+    ("ISISDVOUCHER", "No"),
+    ("ISEXCISEOVERRIDDEN", "No"),
+    ("ISEXCISESUPPLYVCH", "No"),
+    ("ISGSTOVERRIDDEN", "No"),
+    ("GSTNOTEXPORTED", "No"),
+    ("IGNOREGSTINVALIDATION", "No"),
+    ("ISGSTREFUND", "No"),
+    ("OVRDNEWAYBILLTHRESHOLD", "No"),
+    ("ISGSTSECSEVENAPPLICABLE", "No"),
+    ("ISVATPRINCIPALACCOUNT", "No"),
+    ("VCHSTATUSISVCHNUMUSED", "No"),
+    ("VCHGSTSTATUSISINCLUDED", "No"),
+    ("VCHGSTSTATUSISUNCERTAIN", "No"),
+    ("VCHGSTSTATUSISEXCLUDED", "No"),
+    ("VCHGSTSTATUSISAPPLICABLE", "No"),
+    ("VCHGSTSTATUSISGSTR2BRECONCILED", "No"),
+    ("VCHGSTSTATUSISGSTR2BONLYINPORTAL", "No"),
+    ("VCHGSTSTATUSISGSTR2BONLYINBOOKS", "No"),
+    ("VCHGSTSTATUSISGSTR2BMISMATCH", "No"),
+    ("VCHGSTSTATUSISGSTR2BINDIFFPERIOD", "No"),
+    ("VCHGSTSTATUSISRETEFFDATEOVERRDN", "No"),
+    ("VCHGSTSTATUSISOVERRDN", "No"),
+    ("VCHGSTSTATUSISSTATINDIFFDATE", "No"),
+    ("VCHGSTSTATUSISRETINDIFFDATE", "No"),
+    ("VCHGSTSTATUSMAINSECTIONEXCLUDED", "No"),
+    ("VCHGSTSTATUSISBRANCHTRANSFEROUT", "No"),
+    ("VCHGSTSTATUSISSYSTEMGENERATED", "No"),
+    ("VCHSTATUSISUNREGISTEREDRCM", "No"),
+    ("VCHSTATUSISOPTIONAL", "No"),
+    ("VCHSTATUSISCANCELLED", "No"),
+    ("VCHSTATUSISDELETED", "No"),
+    ("VCHSTATUSISOPENINGBALANCE", "No"),
+    ("VCHSTATUSISFETCHEDONLY", "No"),
+    ("PAYMENTLINKHASMULTIREF", "No"),
+    ("ISSHIPPINGWITHINSTATE", "No"),
+    ("ISOVERSEASTOURISTTRANS", "No"),
+    ("ISDESIGNATEDZONEPARTY", "No"),
+    ("HASCASHFLOW", "Yes"),
+    ("ISPOSTDATED", "No"),
+    ("USETRACKINGNUMBER", "No"),
+    ("ISINVOICE", "Yes"),
+    ("MFGJOURNAL", "No"),
+    ("HASDISCOUNTS", "No"),
+    ("ASPAYSLIP", "No"),
+    ("ISCOSTCENTRE", "No"),
+    ("ISSTXNONREALIZEDVCH", "No"),
+    ("ISEXCISEMANUFACTURERVCH", "No"),
+    ("ISBLANKCHEQUE", "No"),
+    ("ISVOID", "No"),
+    ("ORDERLINESTATUS", "No"),
+    ("VATISAGNSTCANCSALES", "No"),
+    ("VATISPURCEXEMPTED", "No"),
+    ("ISVATRESTAXINVOICE", "No"),
+    ("VATISASSESABLECALCVCH", "No"),
+    ("ISVATDUTYPAID", "Yes"),
+    ("ISDELIVERYSAMEASCONSIGNEE", "No"),
+    ("ISDISPATCHSAMEASCONSIGNOR", "No"),
+    ("CHANGEVCHMODE", "No"),
+    ("RESETIRNQRCODE", "No"),
+    ("ALTERID", "1"),
+    ("MASTERID", "2"),
+    ("VOUCHERKEY", "192837465019283746502"),
+)
+
+# Tally voucher elements are built with lxml, which escapes text and serializes in C
+E = ElementMaker()
+
+# lxml escapes markup but rejects characters XML can't hold at all (control characters)
+_XML_UNSAFE_TRANS = str.maketrans({**{chr(code): ' ' for code in range(32)}, '\ufffe': None, '\uffff': None})
+
+def _xml_text(value) -> str:
+    """Make an extracted value safe to use as element text"""
+    return str(value).translate(_XML_UNSAFE_TRANS)
+
+def _ledger_entry(ledger_name: str, deemed_positive: str, is_party: str, amount: str) -> etree._Element:
+    """Build one <ALLLEDGERENTRIES.LIST> voucher line"""
+    return E('ALLLEDGERENTRIES.LIST',
+             E.LEDGERNAME(ledger_name),
+             E.GSTCLASS(),
+             E.ISDEEMEDPOSITIVE(deemed_positive),
+             E.LEDGERFROMITEM('No'),
+             E.REMOVEZEROENTRIES('No'),
+             E.ISPARTYLEDGER(is_party),
+             E.AMOUNT(amount))
+
+def _build_voucher_template() -> etree._Element:
+    """Build the voucher envelope once: every static field filled in, the dynamic ones left empty"""
+    voucher = E.VOUCHER(
+        E.DATE(),
+        E.VOUCHERTYPENAME('Purchase'),
+        E.VOUCHERNUMBER(),
+        E.PARTYLEDGERNAME(),
+        E.CSTFORMISSUETYPE(),
+        E.CSTFORMRECVTYPE(),
+        E.FBTPAYMENTTYPE('Default'),
+        E.PERSISTEDVIEW('Invoice Voucher View'),
+        E.VCHGSTCLASS(),
+        *[E(tag, value) for tag, value in _VOUCHER_FLAGS_HEAD],
+        E.EFFECTIVEDATE(),
+        *[E(tag, value) for tag, value in _VOUCHER_FLAGS_TAIL],
+        REMOTEID="", VCHKEY="", VCHTYPE="Purchase", ACTION="Create", OBJVIEW="Invoice Voucher View"
+    )
+    
+    message = etree.Element('TALLYMESSAGE', nsmap={'UDF': 'TallyUDF'})
+    message.append(voucher)
+    
+    return E.ENVELOPE(
+        E.HEADER(E.TALLYREQUEST('Import Data')),
+        E.BODY(E.IMPORTDATA(
+            E.REQUESTDESC(E.REPORTNAME('Vouchers')),
+            E.REQUESTDATA(message)
+        ))
+    )
+
+# Deep-copied per voucher (in C) instead of re-creating the ~90 static elements in Python
+_VOUCHER_TEMPLATE = _build_voucher_template()
+_XP_VOUCHER = etree.XPath('/ENVELOPE/BODY/IMPORTDATA/REQUESTDATA/TALLYMESSAGE/VOUCHER')
+
 class InvoiceProcessor:
-    def __init__(self, deepinfra_token: str):
+    def __init__(self, deepinfra_token: str, max_concurrency: int = 4,
+                 cache_dir=DEFAULT_CACHE_DIR, use_cache: bool = True, rpm: int = 0, tpm: int = 0,
+                 batch_size: int = 1, dpi: int = RENDER_DPI, jpeg_quality: int = JPEG_QUALITY):
         self.deepinfra_token = deepinfra_token
+        self.max_concurrency = max_concurrency  # LLM requests in flight per processor, across all invoices
+        # Shared by every thread and every PDF's private event loop, so concurrent invoices don't multiply it
+        self._llm_slots = threading.BoundedSemaphore(max(1, max_concurrency))
+        self.batch_size = batch_size  # PDF pages per LLM request (1 = one request per page)
+        self.dpi = dpi  # PDF rasterization resolution
+        self.jpeg_quality = jpeg_quality
         self.api_url = "https://api.deepinfra.com/v1/openai/chat/completions"
         self.model = "meta-llama/Llama-4-Maverick-17B-128E-Instruct-FP8"
+        self.cache = ExtractionCache(cache_dir) if use_cache else None
+        self.limiter = RateLimiter(rpm, tpm)
+        self._headers = {**_HEADERS_BASE, "Authorization": f"Bearer {deepinfra_token}"}
+        # Keep-alive HTTP/2 client reused by single-image requests across invoices; PDFs run pages on
+        # their own event loop, so each PDF opens one AsyncClient that its pages share
+        self._client = httpx.Client(http2=True, headers=self._headers, timeout=LLM_TIMEOUT, limits=LLM_LIMITS)
+    
+    def close(self):
+        """Close pooled LLM connections"""
+        self._client.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
     
-    def encode_image_to_base64(self, image_path: str) -> str:
-        """Convert image to base64 for API"""
+    def _cache_key(self, image_bytes: bytes) -> str:
+        """Cache key for one image under the current model and prompt"""
+        return ExtractionCache.make_key(image_bytes, self.model.encode(), PROMPT_VERSION.encode())
+    
+    def process_image_file(self, image_path: str) -> Dict[str, Any]:
+        """Process a single image file through LLAMA Maverick API"""
         with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
+            return self.process_image_with_llm(image_file.read(), image_path)
     
-    def process_image_with_llm(self, image_path: str) -> Dict[str, Any]:
-        """Process single image through LLAMA Maverick API"""
-        try:
-            # Encode image
-            base64_image = self.encode_image_to_base64(image_path)
-            data_url = f"data:image/jpeg;base64,{base64_image}"
-            
-            # Prepare API request
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.deepinfra_token}"
-            }
-            
-            payload = {
-                "model": self.model,
-                "max_tokens": 4092,
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": """Extract invoice data and return as JSON with this structure:
-                                {
-                                    "invoice_number": "",
-                                    "date": "",
-                                    "vendor_name": "",
-                                    "vendor_address": "",
-                                    "total_amount": 0.0,
-                                    "tax_amount": 0.0,
-                                    "line_items": [
-                                        {
-                                            "description": "",
-                                            "quantity": 0,
-                                            "rate": 0.0,
-                                            "amount": 0.0
-                                        }
-                                    ]
-                                }"""
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {"url": data_url}
-                            }
-                        ]
-                    }
-                ]
-            }
+    def _cache_lookup(self, image_bytes: bytes, source: str) -> tuple:
+        """Return (cache key, cached extraction or None); the key is None when caching is off"""
+        if not self.cache:
+            return None, None
+        key = self._cache_key(image_bytes)
+        cached = self.cache.get(key)
+        if cached is not None:
+            logger.info(f"Using cached extraction for {source}")
+        return key, cached
+    
+    def _build_payload(self, images: List[bytes], prompt: str = _EXTRACTION_PROMPT) -> Dict[str, Any]:
+        """Build the JSON payload of one extraction request (prompt followed by the images)"""
+        content = [{"type": "text", "text": prompt}]
+        for image_bytes in images:
+            # base64 output is pure ASCII, which decodes faster than UTF-8
+            data_url = f"data:{_image_mime(image_bytes)};base64,{base64.b64encode(image_bytes).decode('ascii')}"
+            content.append({"type": "image_url", "image_url": {"url": data_url}})
+        
+        return {
+            "model": self.model,
+            "max_tokens": 4092 * len(images),
+            "messages": [{"role": "user", "content": content}]
+        }
+    
+    def _estimate_tokens(self, payload: Dict[str, Any]) -> int:
+        """Rough token cost of a request for rate limiting: prompt text, images and the completion budget"""
+        estimate = payload['max_tokens']
+        for message in payload['messages']:
+            # Plain-string content (replayed answers, repair prompts) or a list of text/image blocks
+            if isinstance(message['content'], str):
+                estimate += len(message['content']) // 4
+                continue
+            for block in message['content']:
+                estimate += len(block['text']) // 4 if block['type'] == 'text' else IMAGE_TOKEN_ESTIMATE
+        return estimate
+    
+    def _post_llm(self, payload: Dict[str, Any]) -> httpx.Response:
+        """POST one completion request, paced by the rate limiter and retried on 429"""
+        self.limiter.acquire(self._estimate_tokens(payload))
+        
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            # Pre-encoded body; the client already sends Content-Type: application/json
+            with self._llm_slots:
+                response = self._client.post(self.api_url, content=_json_dumps(payload))
+            self.limiter.update_from_headers(response.headers)
+            if response.status_code != 429 or attempt == RATE_LIMIT_RETRIES:
+                break
             
-            response = requests.post(self.api_url, headers=headers, json=payload)
-            response.raise_for_status()
+            # Pause everyone, then go first: this request keeps its place instead of re-queueing
+            delay = self.limiter.retry_delay(response.headers, attempt)
+            logger.warning(f"Rate limited by the LLM API, retrying in {delay:.1f}s")
+            self.limiter.pause(delay)
+            time.sleep(delay)
+        
+        response.raise_for_status()
+        return response
+    
+    async def _acquire_slot_async(self) -> None:
+        """Take a processor-wide request slot without blocking the event loop (cancel-safe: polls)"""
+        while not self._llm_slots.acquire(blocking=False):
+            await asyncio.sleep(0.02)
+    
+    async def _post_llm_async(self, client: httpx.AsyncClient, payload: Dict[str, Any]) -> httpx.Response:
+        """Async variant of _post_llm"""
+        await self.limiter.acquire_async(self._estimate_tokens(payload))
+        
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            await self._acquire_slot_async()
+            try:
+                response = await client.post(self.api_url, content=_json_dumps(payload))
+            finally:
+                self._llm_slots.release()
+            self.limiter.update_from_headers(response.headers)
+            if response.status_code != 429 or attempt == RATE_LIMIT_RETRIES:
+                break
             
-            result = response.json()
+            delay = self.limiter.retry_delay(response.headers, attempt)
+            logger.warning(f"Rate limited by the LLM API, retrying in {delay:.1f}s")
+            self.limiter.pause(delay)
+            await asyncio.sleep(delay)
+        
+        response.raise_for_status()
+        return response
+    
+    def _parse_llm_response(self, result: Dict[str, Any], fallback_re=_JSON_BRACE_RE):
+        """Extract the invoice JSON (an object, or an array for batches) from a chat completion response"""
+        content = result['choices'][0]['message']['content']
+        
+        # Extract JSON from response
+        try:
+            # Try to parse as JSON directly
+            return _json_loads(content)
+        except json.JSONDecodeError:
+            # If not direct JSON, try a ```json block, then any JSON-like structure
+            json_match = _JSON_BLOCK_RE.search(content) or fallback_re.search(content)
+            if json_match:
+                return _json_loads(json_match.group(json_match.lastindex or 0))
+            raise ValueError("Could not extract JSON from LLM response")
+    
+    def _parse_or_repair(self, messages: List[Dict[str, Any]], result: Dict[str, Any], attempt: int) -> tuple:
+        """Parse and validate one extraction; return (extraction, None), or (None, messages to retry with)
+        
+        The retry messages replay the model's answer and the error so it can fix its own output.
+        Raises once REPAIR_RETRIES retries have been used.
+        """
+        try:
+            extraction = self._parse_llm_response(result)
+            _validate_extraction(extraction)
+            return extraction, None
+        except ValueError as e:
+            if attempt >= REPAIR_RETRIES:
+                raise
+            logger.warning(f"Invalid extraction ({str(e)}), asking the model to fix it")
             content = result['choices'][0]['message']['content']
+            return None, messages + [
+                {"role": "assistant", "content": content},
+                {"role": "user", "content": f"Your output had error: {e}. Fix and return valid JSON only."}
+            ]
+    
+    def _extract(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Run one extraction request, retrying with feedback while the answer is invalid"""
+        messages = payload['messages']
+        attempt = 0
+        while True:
+            response = self._post_llm({**payload, "messages": messages})
+            extraction, messages = self._parse_or_repair(messages, _json_loads(response.content), attempt)
+            if messages is None:
+                return extraction
+            attempt += 1
+            time.sleep(1.0 * attempt)
+    
+    async def _extract_async(self, client: httpx.AsyncClient, semaphore: asyncio.Semaphore,
+                             payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Async variant of _extract; the semaphore is only held while a request is in flight"""
+        messages = payload['messages']
+        attempt = 0
+        while True:
+            async with semaphore:
+                response = await self._post_llm_async(client, {**payload, "messages": messages})
+            extraction, messages = self._parse_or_repair(messages, _json_loads(response.content), attempt)
+            if messages is None:
+                return extraction
+            attempt += 1
+            await asyncio.sleep(1.0 * attempt)
+    
+    def process_image_with_llm(self, image_bytes: bytes, source: str = "image") -> Dict[str, Any]:
+        """Process single image (raw bytes) through LLAMA Maverick API"""
+        try:
+            key, cached = self._cache_lookup(image_bytes, source)
+            if cached is not None:
+                return cached
             
-            # Extract JSON from response
-            try:
-                # Try to parse as JSON directly
-                return json.loads(content)
-            except json.JSONDecodeError:
-                # If not direct JSON, try to extract JSON block
-                import re
-                json_match = re.search(r'```json\n(.*?)\n```', content, re.DOTALL)
-                if json_match:
-                    return json.loads(json_match.group(1))
-                else:
-                    # Fallback: try to find JSON-like structure
-                    json_match = re.search(r'\{.*\}', content, re.DOTALL)
-                    if json_match:
-                        return json.loads(json_match.group(0))
-                    else:
-                        raise ValueError("Could not extract JSON from LLM response")
+            result = self._extract(self._build_payload([image_bytes]))
+            if key:
+                self.cache.set(key, result)
+            return result
                         
         except Exception as e:
-            logger.error(f"Error processing image {image_path}: {str(e)}")
+            logger.error(f"Error processing image {source}: {str(e)}")
             raise
     
+    async def _aprocess_image(self, client: httpx.AsyncClient, semaphore: asyncio.Semaphore,
+                              image_bytes: bytes, source: str, key: Optional[str]) -> Dict[str, Any]:
+        """Async variant of process_image_with_llm for a page already missed in the cache (key is None when caching is off)"""
+        try:
+            result = await self._extract_async(client, semaphore, self._build_payload([image_bytes]))
+            if key:
+                self.cache.set(key, result)
+            return result
+                        
+        except Exception as e:
+            logger.error(f"Error processing image {source}: {str(e)}")
+            raise
+    
+    async def _check_batch_results(self, client: httpx.AsyncClient, semaphore: asyncio.Semaphore,
+                                   batch: List[tuple], results: list) -> List[Dict[str, Any]]:
+        """Validate and cache each page of a batch answer; invalid pages are redone on their own (with repair)"""
+        retry = []
+        for index, ((page_num, _, key), result) in enumerate(zip(batch, results)):
+            try:
+                _validate_extraction(result)
+            except ValueError as e:
+                logger.warning(f"Batch result for page {page_num + 1} is invalid ({str(e)}), retrying it on its own")
+                retry.append(index)
+                continue
+            if key:
+                self.cache.set(key, result)
+        
+        redone = await asyncio.gather(*(
+            self._aprocess_image(client, semaphore, image_bytes, f"page {page_num + 1}", key)
+            for page_num, image_bytes, key in (batch[index] for index in retry)
+        ))
+        for index, result in zip(retry, redone):
+            results[index] = result
+        return results
+    
+    async def _aprocess_batch(self, client: httpx.AsyncClient, semaphore: asyncio.Semaphore,
+                              batch: List[tuple]) -> List[Dict[str, Any]]:
+        """Extract several (page number, image, cache key) pages with one request, one page at a time if the answer doesn't line up"""
+        if len(batch) > 1:
+            try:
+                payload = self._build_payload([image_bytes for _, image_bytes, _ in batch],
+                                              _BATCH_PROMPT_HEAD.format(count=len(batch)) + _EXTRACTION_SCHEMA)
+                async with semaphore:
+                    response = await self._post_llm_async(client, payload)
+                results = self._parse_llm_response(_json_loads(response.content), _JSON_ARRAY_RE)
+                
+                if isinstance(results, list) and len(results) == len(batch):
+                    return await self._check_batch_results(client, semaphore, batch, results)
+                
+                count = len(results) if isinstance(results, list) else 'no'
+                logger.warning(f"Batch of {len(batch)} pages returned {count} results, retrying one page per request")
+            except (ValueError, KeyError, IndexError, TypeError) as e:
+                logger.warning(f"Could not parse batch of {len(batch)} pages ({str(e)}), retrying one page per request")
+        
+        return await asyncio.gather(*(
+            self._aprocess_image(client, semaphore, image_bytes, f"page {page_num + 1}", key)
+            for page_num, image_bytes, key in batch
+        ))
+    
+    async def _aprocess_unit(self, client: httpx.AsyncClient, semaphore: asyncio.Semaphore,
+                             unit: List[tuple]) -> tuple:
+        """Extract one unit of work (a page, or a batch of pages) and return (unit, extractions)"""
+        if len(unit) == 1:
+            page_num, image_bytes, key = unit[0]
+            return unit, [await self._aprocess_image(client, semaphore, image_bytes, f"page {page_num + 1}", key)]
+        return unit, await self._aprocess_batch(client, semaphore, unit)
+    
+    async def _process_pages_async(self, images: List[bytes], batch_size: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Send every page image to the LLM concurrently (at most max_concurrency at once), in page order
+        
+        Results are collected as they arrive, with progress logged per page. Each finished page is
+        written to the extraction cache straight away, so a crash part-way through a long PDF only
+        re-requests the pages that had not come back yet.
+        """
+        batch_size = max(1, batch_size or self.batch_size)
+        semaphore = asyncio.Semaphore(max(1, self.max_concurrency))
+        
+        # Cached pages are answered locally; only the rest are sent, batch_size pages per request,
+        # each carrying its cache key so it's stored without being hashed or looked up again
+        results = [None] * len(images)
+        pending = []
+        for page_num, image_bytes in enumerate(images):
+            key, cached = self._cache_lookup(image_bytes, f"page {page_num + 1}")
+            if cached is not None:
+                results[page_num] = cached
+            else:
+                pending.append((page_num, image_bytes, key))
+        
+        if not pending:
+            return results
+        
+        done = len(images) - len(pending)
+        async with httpx.AsyncClient(http2=True, headers=self._headers, timeout=LLM_TIMEOUT, limits=LLM_LIMITS) as client:
+            tasks = [asyncio.ensure_future(self._aprocess_unit(client, semaphore, pending[i:i + batch_size]))
+                     for i in range(0, len(pending), batch_size)]
+            try:
+                for next_done in asyncio.as_completed(tasks):
+                    unit, extracted = await next_done
+                    for (page_num, _, _), result in zip(unit, extracted):
+                        results[page_num] = result
+                    done += len(unit)
+                    logger.info(f"Extracted {done}/{len(images)} pages")
+            finally:
+                # One failed page fails the PDF; don't leave the other requests running
+                for task in tasks:
+                    task.cancel()
+        
+        return results
+    
+    def process_images_batched(self, image_bytes_list: List[bytes], batch_size: int = 4) -> List[Dict[str, Any]]:
+        """Extract several page images, batch_size images per LLM request, in input order"""
+        return asyncio.run(self._process_pages_async(image_bytes_list, batch_size))
+    
     def process_invoice_file(self, file_path: str) -> List[Dict[str, Any]]:
         """Process invoice file (handles PDF pages and single images)"""
         file_path = Path(file_path)
@@ -112,38 +810,62 @@ class InvoiceProcessor:
             return self.process_pdf(file_path)
         else:
             # Single image
-            result = self.process_image_with_llm(str(file_path))
+            result = self.process_image_file(str(file_path))
+            return [result]
+    
+    def process_invoice_stream(self, stream, filename: str) -> List[Dict[str, Any]]:
+        """Process an uploaded invoice from a file-like object, without saving the upload first"""
+        return self.process_bytes(stream.read(), Path(filename).suffix, source=filename)
+    
+    def process_bytes(self, data: bytes, suffix: str, source: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Process an invoice held in memory; suffix ('.pdf', '.jpg', ...) picks PDF or image handling"""
+        if suffix.lower() == '.pdf':
+            return self._process_pdf_source(data)
+        else:
+            # Single image
+            result = self.process_image_with_llm(data, source or f"image{suffix}")
             return [result]
     
     def process_pdf(self, pdf_path: Path) -> List[Dict[str, Any]]:
         """Convert PDF pages to images and process each"""
-        try:
-            import fitz  # PyMuPDF
-        except ImportError:
-            raise ImportError("PyMuPDF is required for PDF processing. Install with: pip install PyMuPDF")
-        
-        results = []
-        doc = fitz.open(pdf_path)
+        return self._process_pdf_source(str(pdf_path))
+    
+    def _process_pdf_source(self, source) -> List[Dict[str, Any]]:
+        """Rasterize every page of a PDF (path or bytes) and process each"""
+        images = self._rasterize_pages(source)
         
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            pix = page.get_pixmap()
-            
-            # Save page as temporary image in /tmp/
-            temp_image_path = f"/tmp/temp_page_{page_num}.png"
-            pix.save(temp_image_path)
+        # LLM calls are I/O-bound, so pages are awaited together on a private event loop
+        # (process_pdf is sync; the web app already runs it in a worker thread)
+        return asyncio.run(self._process_pages_async(images))
+    
+    def _rasterize_pages(self, source) -> List[bytes]:
+        """Render every page to JPEG bytes, in page order"""
+        doc = _open_pdf(source)
+        try:
+            num_pages = len(doc)
+            n_workers = min(os.cpu_count() or 1, num_pages)
             
-            try:
-                # Process page through LLM
-                page_result = self.process_image_with_llm(temp_image_path)
-                results.append(page_result)
-            finally:
-                # Clean up temp file
-                if os.path.exists(temp_image_path):
-                    os.remove(temp_image_path)
+            # Short PDFs render faster than worker processes start, so they stay in-process; so does
+            # everything inside a daemon process (e.g. hypercorn --workers), which can't have children
+            if num_pages < PARALLEL_RENDER_MIN_PAGES or n_workers < 2 or multiprocessing.current_process().daemon:
+                return [image for _, image in _render_pages(doc, 0, num_pages, self.dpi, self.jpeg_quality)]
+        finally:
+            doc.close()
         
-        doc.close()
-        return results
+        # Rendering is CPU-bound and PyMuPDF is not thread-safe, so each process renders one page range.
+        # spawn, not fork: the web app calls this from a worker thread of a running event loop
+        try:
+            with multiprocessing.get_context('spawn').Pool(n_workers) as pool:
+                segments = pool.map(_render_segment, [(i, n_workers, source, self.dpi, self.jpeg_quality)
+                                                      for i in range(n_workers)])
+        except (OSError, AssertionError) as e:
+            # Sandboxes without process/semaphore support (or daemonic callers): render serially instead
+            logger.warning(f"Parallel rendering unavailable ({str(e)}), rendering {num_pages} pages serially")
+            segments = [_render_segment((0, 1, source, self.dpi, self.jpeg_quality))]
+        
+        pages = sorted((page for segment in segments for page in segment), key=lambda page: page[0])
+        return [image for _, image in pages]
+    
     def merge_json_data(self, json_list: List[Dict[str, Any]]) -> Dict[str, Any]:
         """Merge multiple JSON extractions into one consolidated result"""
         if not json_list:
@@ -152,210 +874,47 @@ class InvoiceProcessor:
         if len(json_list) == 1:
             return json_list[0]
         
-        # Merge logic for multi-page invoices
-        merged = json_list[0].copy()
-        
-        # Combine line items from all pages
-        all_line_items = []
-        total_amount = 0.0
-        total_tax = 0.0
-        
-        for json_data in json_list:
-            if 'line_items' in json_data:
-                all_line_items.extend(json_data.get('line_items', []))
-            
-            # Sum amounts (take the highest total if different)
-            if 'total_amount' in json_data:
-                total_amount = max(total_amount, json_data.get('total_amount', 0.0))
-            
-            if 'tax_amount' in json_data:
-                total_tax = max(total_tax, json_data.get('tax_amount', 0.0))
-        
-        merged['line_items'] = all_line_items
-        merged['total_amount'] = total_amount
-        merged['tax_amount'] = total_tax
+        # Merge logic for multi-page invoices: header fields from the first page,
+        # line items from every page, and the highest total/tax seen on any page
+        merged = {
+            **json_list[0],
+            'line_items': list(chain.from_iterable(json_data.get('line_items', ()) for json_data in json_list)),
+            'total_amount': max((json_data.get('total_amount', 0.0) for json_data in json_list), default=0.0),
+            'tax_amount': max((json_data.get('tax_amount', 0.0) for json_data in json_list), default=0.0)
+        }
         
         return merged
     
     def json_to_tally_xml(self, json_data: Dict[str, Any]) -> str:
         """Convert extracted JSON to Tally-friendly XML format"""
-        from datetime import datetime
         
         # Format date properly for Tally (YYYYMMDD)
-        date_str = json_data.get('date', '')
-        try:
-            # Try to parse various date formats
-            if '-' in date_str:
-                if len(date_str.split('-')[2]) == 4:  # DD-MM-YYYY
-                    dt = datetime.strptime(date_str, '%d-%b-%Y')
-                else:  # DD-MM-YY
-                    dt = datetime.strptime(date_str, '%d-%m-%y')
-            else:
-                dt = datetime.now()
-            tally_date = dt.strftime('%Y%m%d')
-        except:
-            tally_date = datetime.now().strftime('%Y%m%d')
-        
-        # Create proper Tally XML
-        xml_content = f"""<ENVELOPE>
-    <HEADER>
-        <TALLYREQUEST>Import Data</TALLYREQUEST>
-    </HEADER>
-    <BODY>
-        <IMPORTDATA>
-            <REQUESTDESC>
-                <REPORTNAME>Vouchers</REPORTNAME>
-            </REQUESTDESC>
-            <REQUESTDATA>
-                <TALLYMESSAGE xmlns:UDF="TallyUDF">
-                    <VOUCHER REMOTEID="" VCHKEY="" VCHTYPE="Purchase" ACTION="Create" OBJVIEW="Invoice Voucher View">
-                        <DATE>{tally_date}</DATE>
-                        <VOUCHERTYPENAME>Purchase</VOUCHERTYPENAME>
-                        <VOUCHERNUMBER>{json_data.get('invoice_number', 'AUTO')}</VOUCHERNUMBER>
-                        <PARTYLEDGERNAME>{json_data.get('vendor_name', 'Sundry Creditors')}</PARTYLEDGERNAME>
-                        <CSTFORMISSUETYPE/>
-                        <CSTFORMRECVTYPE/>
-                        <FBTPAYMENTTYPE>Default</FBTPAYMENTTYPE>
-                        <PERSISTEDVIEW>Invoice Voucher View</PERSISTEDVIEW>
-                        <VCHGSTCLASS/>
-                        <DIFFACTUALQTY>No</DIFFACTUALQTY>
-                        <ISMSTFROMSYNC>No</ISMSTFROMSYNC>
-                        <ASORIGINAL>No</ASORIGINAL>
-                        <AUDITED>No</AUDITED>
-                        <FORJOBCOSTING>No</FORJOBCOSTING>
-                        <ISOPTIONAL>No</ISOPTIONAL>
-                        <EFFECTIVEDATE>{tally_date}</EFFECTIVEDATE>
-                        <USEFOREXCISE>No</USEFOREXCISE>
-                        <ISFORJOBWORKIN>No</ISFORJOBWORKIN>
-                        <ALLOWCONSUMPTION>No</ALLOWCONSUMPTION>
-                        <USEFORINTEREST>No</USEFORINTEREST>
-                        <USEFORGAINLOSS>No</USEFORGAINLOSS>
-                        <USEFORGODOWNTRANSFER>No</USEFORGODOWNTRANSFER>
-                        <USEFORCOMPOUND>No</USEFORCOMPOUND>
-                        <USEFORSERVICETAX>No</USEFORSERVICETAX>
-                        <ISEXCISEVOUCHER>No</ISEXCISEVOUCHER>
-                        <EXCISETAXOVERRIDE>No</EXCISETAXOVERRIDE>
-                        <USEFORTAXUNITTRANSFER>No</USEFORTAXUNITTRANSFER>
-                        <IGNOREPOSVALIDATION>No</IGNOREPOSVALIDATION>
-                        <EXCISEOPENING>No</EXCISEOPENING>
-                        <USEFORFINALPRODUCTION>No</USEFORFINALPRODUCTION>
-                        <ISTDSOVERRIDDEN>No</ISTDSOVERRIDDEN>
-                        <ISTCSOVERRIDDEN>No</ISTCSOVERRIDDEN>
-                        <ISTDSTCSCASHVCH>No</ISTDSTCSCASHVCH>
-                        <INCLUDEADVPYMTVCH>No</INCLUDEADVPYMTVCH>
-                        <ISSUBWORKSCONTRACT>No</ISSUBWORKSCONTRACT>
-                        <ISVATOVERRIDDEN>No</ISVATOVERRIDDEN>
-                        <IGNOREORIGVCHDATE>No</IGNOREORIGVCHDATE>
-                        <ISVATPAIDATCUSTOMS>No</ISVATPAIDATCUSTOMS>
-                        <ISDECLAREDTOCUSTOMS>No</ISDECLAREDTOCUSTOMS>
-                        <ISSERVICETAXOVERRIDDEN>No</ISSERVICETAXOVERRIDDEN>
-                        <ISISDVOUCHER>No</ISISDVOUCHER>
-                        <ISEXCISEOVERRIDDEN>No</ISEXCISEOVERRIDDEN>
-                        <ISEXCISESUPPLYVCH>No</ISEXCISESUPPLYVCH>
-                        <ISGSTOVERRIDDEN>No</ISGSTOVERRIDDEN>
-                        <GSTNOTEXPORTED>No</GSTNOTEXPORTED>
-                        <IGNOREGSTINVALIDATION>No</IGNOREGSTINVALIDATION>
-                        <ISGSTREFUND>No</ISGSTREFUND>
-                        <OVRDNEWAYBILLTHRESHOLD>No</OVRDNEWAYBILLTHRESHOLD>
-                        <ISGSTSECSEVENAPPLICABLE>No</ISGSTSECSEVENAPPLICABLE>
-                        <ISVATPRINCIPALACCOUNT>No</ISVATPRINCIPALACCOUNT>
-                        <VCHSTATUSISVCHNUMUSED>No</VCHSTATUSISVCHNUMUSED>
-                        <VCHGSTSTATUSISINCLUDED>No</VCHGSTSTATUSISINCLUDED>
-                        <VCHGSTSTATUSISUNCERTAIN>No</VCHGSTSTATUSISUNCERTAIN>
-                        <VCHGSTSTATUSISEXCLUDED>No</VCHGSTSTATUSISEXCLUDED>
-                        <VCHGSTSTATUSISAPPLICABLE>No</VCHGSTSTATUSISAPPLICABLE>
-                        <VCHGSTSTATUSISGSTR2BRECONCILED>No</VCHGSTSTATUSISGSTR2BRECONCILED>
-                        <VCHGSTSTATUSISGSTR2BONLYINPORTAL>No</VCHGSTSTATUSISGSTR2BONLYINPORTAL>
-                        <VCHGSTSTATUSISGSTR2BONLYINBOOKS>No</VCHGSTSTATUSISGSTR2BONLYINBOOKS>
-                        <VCHGSTSTATUSISGSTR2BMISMATCH>No</VCHGSTSTATUSISGSTR2BMISMATCH>
-                        <VCHGSTSTATUSISGSTR2BINDIFFPERIOD>No</VCHGSTSTATUSISGSTR2BINDIFFPERIOD>
-                        <VCHGSTSTATUSISRETEFFDATEOVERRDN>No</VCHGSTSTATUSISRETEFFDATEOVERRDN>
-                        <VCHGSTSTATUSISOVERRDN>No</VCHGSTSTATUSISOVERRDN>
-                        <VCHGSTSTATUSISSTATINDIFFDATE>No</VCHGSTSTATUSISSTATINDIFFDATE>
-                        <VCHGSTSTATUSISRETINDIFFDATE>No</VCHGSTSTATUSISRETINDIFFDATE>
-                        <VCHGSTSTATUSMAINSECTIONEXCLUDED>No</VCHGSTSTATUSMAINSECTIONEXCLUDED>
-                        <VCHGSTSTATUSISBRANCHTRANSFEROUT>No</VCHGSTSTATUSISBRANCHTRANSFEROUT>
-                        <VCHGSTSTATUSISSYSTEMGENERATED>No</VCHGSTSTATUSISSYSTEMGENERATED>
-                        <VCHSTATUSISUNREGISTEREDRCM>No</VCHSTATUSISUNREGISTEREDRCM>
-                        <VCHSTATUSISOPTIONAL>No</VCHSTATUSISOPTIONAL>
-                        <VCHSTATUSISCANCELLED>No</VCHSTATUSISCANCELLED>
-                        <VCHSTATUSISDELETED>No</VCHSTATUSISDELETED>
-                        <VCHSTATUSISOPENINGBALANCE>No</VCHSTATUSISOPENINGBALANCE>
-                        <VCHSTATUSISFETCHEDONLY>No</VCHSTATUSISFETCHEDONLY>
-                        <PAYMENTLINKHASMULTIREF>No</PAYMENTLINKHASMULTIREF>
-                        <ISSHIPPINGWITHINSTATE>No</ISSHIPPINGWITHINSTATE>
-                        <ISOVERSEASTOURISTTRANS>No</ISOVERSEASTOURISTTRANS>
-                        <ISDESIGNATEDZONEPARTY>No</ISDESIGNATEDZONEPARTY>
-                        <HASCASHFLOW>Yes</HASCASHFLOW>
-                        <ISPOSTDATED>No</ISPOSTDATED>
-                        <USETRACKINGNUMBER>No</USETRACKINGNUMBER>
-                        <ISINVOICE>Yes</ISINVOICE>
-                        <MFGJOURNAL>No</MFGJOURNAL>
-                        <HASDISCOUNTS>No</HASDISCOUNTS>
-                        <ASPAYSLIP>No</ASPAYSLIP>
-                        <ISCOSTCENTRE>No</ISCOSTCENTRE>
-                        <ISSTXNONREALIZEDVCH>No</ISSTXNONREALIZEDVCH>
-                        <ISEXCISEMANUFACTURERVCH>No</ISEXCISEMANUFACTURERVCH>
-                        <ISBLANKCHEQUE>No</ISBLANKCHEQUE>
-                        <ISVOID>No</ISVOID>
-                        <ORDERLINESTATUS>No</ORDERLINESTATUS>
-                        <VATISAGNSTCANCSALES>No</VATISAGNSTCANCSALES>
-                        <VATISPURCEXEMPTED>No</VATISPURCEXEMPTED>
-                        <ISVATRESTAXINVOICE>No</ISVATRESTAXINVOICE>
-                        <VATISASSESABLECALCVCH>No</VATISASSESABLECALCVCH>
-                        <ISVATDUTYPAID>Yes</ISVATDUTYPAID>
-                        <ISDELIVERYSAMEASCONSIGNEE>No</ISDELIVERYSAMEASCONSIGNEE>
-                        <ISDISPATCHSAMEASCONSIGNOR>No</ISDISPATCHSAMEASCONSIGNOR>
-                        <CHANGEVCHMODE>No</CHANGEVCHMODE>
-                        <RESETIRNQRCODE>No</RESETIRNQRCODE>
-                        <ALTERID>1</ALTERID>
-                        <MASTERID>2</MASTERID>
-                        <VOUCHERKEY>192837465019283746502</VOUCHERKEY>
-                        <ALLLEDGERENTRIES.LIST>
-                            <LEDGERNAME>{json_data.get('vendor_name', 'Sundry Creditors')}</LEDGERNAME>
-                            <GSTCLASS/>
-                            <ISDEEMEDPOSITIVE>No</ISDEEMEDPOSITIVE>
-                            <LEDGERFROMITEM>No</LEDGERFROMITEM>
-                            <REMOVEZEROENTRIES>No</REMOVEZEROENTRIES>
-                            <ISPARTYLEDGER>Yes</ISPARTYLEDGER>
-                            <AMOUNT>-{json_data.get('total_amount', 0.0)}</AMOUNT>
-                        </ALLLEDGERENTRIES.LIST>"""
+        tally_date = _parse_date(json_data.get('date', '')).strftime('%Y%m%d')
+        
+        vendor_name = _xml_text(json_data.get('vendor_name', 'Sundry Creditors'))
+        
+        # Ledger lines: the party (credit) first, then line items and tax
+        entries = [_ledger_entry(vendor_name, 'No', 'Yes', f"-{json_data.get('total_amount', 0.0)}")]
         
         # Add line items
         for item in json_data.get('line_items', []):
-            xml_content += f"""
-                        <ALLLEDGERENTRIES.LIST>
-                            <LEDGERNAME>Purchase Account</LEDGERNAME>
-                            <GSTCLASS/>
-                            <ISDEEMEDPOSITIVE>Yes</ISDEEMEDPOSITIVE>
-                            <LEDGERFROMITEM>No</LEDGERFROMITEM>
-                            <REMOVEZEROENTRIES>No</REMOVEZEROENTRIES>
-                            <ISPARTYLEDGER>No</ISPARTYLEDGER>
-                            <AMOUNT>{item.get('amount', 0.0)}</AMOUNT>
-                        </ALLLEDGERENTRIES.LIST>"""
+            entries.append(_ledger_entry('Purchase Account', 'Yes', 'No', str(item.get('amount', 0.0))))
         
         # Add tax if applicable
         if json_data.get('tax_amount', 0.0) > 0:
-            xml_content += f"""
-                        <ALLLEDGERENTRIES.LIST>
-                            <LEDGERNAME>Input Tax</LEDGERNAME>
-                            <GSTCLASS/>
-                            <ISDEEMEDPOSITIVE>Yes</ISDEEMEDPOSITIVE>
-                            <LEDGERFROMITEM>No</LEDGERFROMITEM>
-                            <REMOVEZEROENTRIES>No</REMOVEZEROENTRIES>
-                            <ISPARTYLEDGER>No</ISPARTYLEDGER>
-                            <AMOUNT>{json_data.get('tax_amount', 0.0)}</AMOUNT>
-                        </ALLLEDGERENTRIES.LIST>"""
-        
-        xml_content += """
-                    </VOUCHER>
-                </TALLYMESSAGE>
-            </REQUESTDATA>
-        </IMPORTDATA>
-    </BODY>
-</ENVELOPE>"""
+            entries.append(_ledger_entry('Input Tax', 'Yes', 'No', str(json_data.get('tax_amount', 0.0))))
         
-        return xml_content
+        # Only the dynamic fields are filled in; lxml escapes them, so names like "A & B <Traders>" stay well-formed
+        # (control characters, which XML can't represent, were replaced by _xml_text)
+        envelope = copy.deepcopy(_VOUCHER_TEMPLATE)
+        voucher = _XP_VOUCHER(envelope)[0]
+        voucher.find('DATE').text = tally_date
+        voucher.find('VOUCHERNUMBER').text = _xml_text(json_data.get('invoice_number', 'AUTO'))
+        voucher.find('PARTYLEDGERNAME').text = vendor_name
+        voucher.find('EFFECTIVEDATE').text = tally_date
+        voucher.extend(entries)
+        
+        return etree.tostring(envelope, encoding='unicode')
     
     def save_xml(self, xml_content: str, output_path: str) -> None:
         """Save XML content to file"""
@@ -363,33 +922,35 @@ class InvoiceProcessor:
             f.write(xml_content)
         logger.info(f"XML saved to {output_path}")
     
-    def process_workflow(self, input_file: str, output_xml: str = None) -> str:
-        """Complete end-to-end workflow"""
-        logger.info(f"Starting workflow for {input_file}")
-        
-        # Step 1: Process invoice file
-        json_results = self.process_invoice_file(input_file)
+    def process_bytes_workflow(self, data: bytes, suffix: str,
+                               source: Optional[str] = None) -> Tuple[Dict[str, Any], str]:
+        """End-to-end workflow on in-memory bytes; returns (merged JSON, Tally XML) without touching disk"""
+        # Step 1: Process invoice data
+        json_results = self.process_bytes(data, suffix, source)
         logger.info(f"Extracted {len(json_results)} JSON results")
         
         # Step 2: Merge JSON data (for multi-page PDFs)
         merged_json = self.merge_json_data(json_results)
         
-        # Save intermediate JSON in /tmp/
-        json_output = f"/tmp/{Path(input_file).stem}_extracted.json"
-        with open(json_output, 'w') as f:
-            json.dump(merged_json, f, indent=2)
-        logger.info(f"Merged JSON saved to {json_output}")
-        
         # Step 3: Convert to Tally XML
-        xml_content = self.json_to_tally_xml(merged_json)
+        return merged_json, self.json_to_tally_xml(merged_json)
+    
+    def process_workflow(self, input_file: str, output_xml: str = None) -> str:
+        """Complete end-to-end workflow; returns the XML, also saved with its JSON when output_xml is given"""
+        logger.info(f"Starting workflow for {input_file}")
         
-        # Step 4: Save XML in /tmp/
-        if not output_xml:
-            output_xml = f"/tmp/{Path(input_file).stem}_tally.xml"
+        input_path = Path(input_file)
+        merged_json, xml_content = self.process_bytes_workflow(input_path.read_bytes(), input_path.suffix,
+                                                               source=str(input_path))
         
-        self.save_xml(xml_content, output_xml)
+        # Step 4: Save the intermediate JSON and the XML only when asked to
+        if output_xml:
+            json_output = Path(output_xml).with_name(f"{Path(output_xml).stem}_extracted.json")
+            json_output.write_bytes(_json_dumps(merged_json, indent=True))
+            logger.info(f"Merged JSON saved to {json_output}")
+            self.save_xml(xml_content, output_xml)
         
-        return output_xml
+        return xml_content
 
 
 def main():
@@ -401,6 +962,8 @@ def main():
     parser.add_argument('input_file', help='Input invoice file (PDF/JPG/PNG)')
     parser.add_argument('--output', '-o', help='Output XML file path')
     parser.add_argument('--token', help='DeepInfra API token (overrides config)')
+    parser.add_argument('--no-cache', action='store_true', help='Always call the LLM, ignoring cached extractions')
+    parser.add_argument('--cache-dir', default=str(DEFAULT_CACHE_DIR), help='Directory for cached extractions')
     
     args = parser.parse_args()
     
@@ -413,8 +976,15 @@ def main():
         return 1
     
     try:
-        processor = InvoiceProcessor(token)
-        output_file = processor.process_workflow(args.input_file, args.output)
+        with InvoiceProcessor(token, cache_dir=args.cache_dir, use_cache=not args.no_cache,
+                              rpm=config['llm_rpm'], tpm=config['llm_tpm'],
+                              batch_size=config['llm_batch_size']) as processor:
+            output_file = args.output
+            if not output_file:
+                # Default to a unique name in /tmp/, so concurrent runs on same-named files don't collide
+                fd, output_file = tempfile.mkstemp(prefix=f"{Path(args.input_file).stem}_", suffix="_tally.xml")
+                os.close(fd)
+            processor.process_workflow(args.input_file, output_file)
         print(f"Success! Tally XML generated: {output_file}")
         return 0
     except Exception as e:
@@ -1,6 +1,6 @@
 from app import app
 
-# WSGI entry point for serverless deployment
+# ASGI entry point for serverless deployment (Quart app)
 application = app
 
 if __name__ == "__main__":